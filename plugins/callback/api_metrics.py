@@ -0,0 +1,232 @@
+# Copyright: (c) 2021, Equinix Metal
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: api_metrics
+    type: aggregate
+    short_description: Summarize the Equinix Metal API requests of each play
+    description:
+        - Collect the C(metal_metrics) results of the tasks of the modules of this collection run with I(api_metrics=true),
+          and the requests of the C(equinix.metal.device) inventory appended to I(metrics_file), and print a summary per play
+          at the end of the playbook.
+        - The summary gives the number of calls, errors and throttled requests and the median and 95th percentile latency
+          per endpoint, and the tasks which spent the most time waiting for the API.
+        - Latency percentiles are estimated from the latency histograms of the modules, so they are rounded up to the bucket they fall in.
+    version_added: 1.5.0
+    requirements:
+        - enable in configuration
+    options:
+        metrics_file:
+            description:
+                - The I(api_metrics_file) the inventory appends its API requests to.
+                - Only the requests sent by the inventory of the running playbook are read from it, from where the inventory
+                  started appending to it, so the file may be shared by successive and concurrent runs.
+            type: path
+            env:
+                - name: METAL_API_METRICS_FILE
+            ini:
+                - section: callback_equinix_metal_api_metrics
+                  key: metrics_file
+        slowest_tasks:
+            description: How many of the tasks spending the most time on API requests to list per play.
+            type: int
+            default: 5
+            env:
+                - name: METAL_API_METRICS_SLOWEST_TASKS
+            ini:
+                - section: callback_equinix_metal_api_metrics
+                  key: slowest_tasks
+        summary_file:
+            description:
+                - A file to write the summary to as JSON too, e.g. to compare the API cost of successive versions of a playbook.
+            type: path
+            env:
+                - name: METAL_API_METRICS_SUMMARY_FILE
+            ini:
+                - section: callback_equinix_metal_api_metrics
+                  key: summary_file
+'''
+
+import json
+import os
+from collections import OrderedDict
+
+from ansible.module_utils._text import to_native
+from ansible.plugins.callback import CallbackBase
+
+from ansible_collections.equinix.metal.plugins.module_utils.metal import (
+    API_METRICS_FILE_OFFSETS,
+    API_METRICS_RUN_ID,
+    LATENCY_BUCKETS,
+)
+
+
+def new_endpoint_stats():
+    return {
+        'calls': 0, 'errors': 0, 'retries': 0, 'throttled': 0, 'bytes_sent': 0, 'bytes_received': 0,
+        'elapsed': 0.0, 'max_elapsed': 0.0, 'latency_histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+
+def merge_endpoints(totals, endpoints):
+    """Add the per endpoint metrics of a metal_metrics result to totals"""
+    for endpoint, stats in endpoints.items():
+        total = totals.setdefault(endpoint, new_endpoint_stats())
+        for key in ('calls', 'errors', 'retries', 'throttled', 'bytes_sent', 'bytes_received', 'elapsed'):
+            total[key] += stats.get(key, 0)
+        total['max_elapsed'] = max(total['max_elapsed'], stats.get('max_elapsed', 0.0))
+        histogram = stats.get('latency_histogram') or []
+        if len(histogram) == len(total['latency_histogram']):
+            total['latency_histogram'] = [a + b for a, b in zip(total['latency_histogram'], histogram)]
+
+
+def record_endpoints(record):
+    """The per endpoint metrics of a request appended to an api_metrics_file"""
+    status, elapsed = record.get('status'), record.get('elapsed', 0.0)
+    stats = new_endpoint_stats()
+    stats.update({
+        'calls': 1,
+        'errors': int(status is None or status >= 400),
+        'retries': int(record.get('attempt', 0) > 0),
+        'throttled': int(status == 429),
+        'bytes_sent': record.get('bytes_sent', 0),
+        'bytes_received': record.get('bytes_received', 0),
+        'elapsed': elapsed,
+        'max_elapsed': elapsed,
+    })
+    stats['latency_histogram'][len([b for b in LATENCY_BUCKETS if elapsed > b])] += 1
+    return {record.get('endpoint'): stats}
+
+
+def percentile(stats, q):
+    """The latency under which a fraction q of the calls of an endpoint were answered, rounded up to its bucket"""
+    histogram = stats['latency_histogram']
+    rank = q * sum(histogram)
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram):
+        seen += count
+        if count and seen >= rank:
+            return min(bound, stats['max_elapsed'])
+    return stats['max_elapsed']
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'equinix.metal.api_metrics'
+    CALLBACK_NEEDS_WHITELIST = True
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self, display=None):
+        super(CallbackModule, self).__init__(display=display)
+        self._plays = []
+        self._metrics_file_offset = 0
+
+    def _new_section(self, name):
+        section = {'name': name, 'endpoints': {}, 'tasks': OrderedDict()}
+        self._plays.append(section)
+        return section
+
+    def _read_metrics_file(self, section):
+        """Add the requests appended to metrics_file by this run since the last read to section"""
+        path = self.get_option('metrics_file')
+        if not path:
+            return
+        path = os.path.realpath(os.path.expanduser(path))
+        if path not in API_METRICS_FILE_OFFSETS:
+            # the inventory did not send any request yet
+            return
+        try:
+            with open(path) as f:
+                f.seek(max(self._metrics_file_offset, API_METRICS_FILE_OFFSETS[path]))
+                lines = f.readlines()
+                self._metrics_file_offset = f.tell()
+        except (IOError, OSError):
+            return
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('run') == API_METRICS_RUN_ID:
+                merge_endpoints(section['endpoints'], record_endpoints(record))
+
+    def v2_playbook_on_start(self, playbook):
+        # the inventory was parsed already
+        self._read_metrics_file(self._new_section('inventory'))
+
+    def v2_playbook_on_play_start(self, play):
+        if self._plays:
+            # refresh_inventory meta tasks of the previous play
+            self._read_metrics_file(self._plays[-1])
+        self._new_section(play.get_name())
+
+    def _record_result(self, result):
+        if not self._plays:
+            self._new_section('')
+        section = self._plays[-1]
+        results = [result._result] + [r for r in result._result.get('results', []) if isinstance(r, dict)]
+        for metrics in [r['metal_metrics'] for r in results if isinstance(r.get('metal_metrics'), dict)]:
+            endpoints = metrics.get('endpoints') or {}
+            merge_endpoints(section['endpoints'], endpoints)
+            task = section['tasks'].setdefault((result._task._uuid, result._host.get_name()), {
+                'task': result._task.get_name(), 'host': result._host.get_name(), 'calls': 0, 'elapsed': 0.0, 'throttled': 0,
+            })
+            task['calls'] += sum(e.get('calls', 0) for e in endpoints.values())
+            task['elapsed'] += sum(e.get('elapsed', 0.0) for e in endpoints.values())
+            task['throttled'] += sum(e.get('throttled', 0) for e in endpoints.values())
+
+    def v2_runner_on_ok(self, result):
+        self._record_result(result)
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record_result(result)
+
+    def summarize(self):
+        """The summary of the API requests of every play, leaving out the plays which sent none"""
+        summary = []
+        for section in self._plays:
+            if not section['endpoints']:
+                continue
+            tasks = sorted(section['tasks'].items(), key=lambda item: -item[1]['elapsed'])
+            summary.append({
+                'play': section['name'],
+                'calls': sum(e['calls'] for e in section['endpoints'].values()),
+                'throttled': sum(e['throttled'] for e in section['endpoints'].values()),
+                'endpoints': OrderedDict(
+                    (endpoint, dict(stats, p50=percentile(stats, 0.5), p95=percentile(stats, 0.95)))
+                    for endpoint, stats in sorted(section['endpoints'].items(), key=lambda item: -item[1]['calls'])
+                ),
+                'slowest_tasks': [dict(stats) for _, stats in tasks[:self.get_option('slowest_tasks')]],
+            })
+        return summary
+
+    def v2_playbook_on_stats(self, stats):
+        if self._plays:
+            self._read_metrics_file(self._plays[-1])
+        summary = self.summarize()
+
+        for play in summary:
+            self._display.banner('EQUINIX METAL API: %s' % (play['play'] or 'play'))
+            self._display.display('%d calls, %d throttled' % (play['calls'], play['throttled']))
+            width = max(len(endpoint) for endpoint in play['endpoints'])
+            for endpoint, endpoint_stats in play['endpoints'].items():
+                self._display.display('%-*s  calls=%-5d errors=%-4d throttled=%-4d p50=%.2fs p95=%.2fs' % (
+                    width, endpoint, endpoint_stats['calls'], endpoint_stats['errors'], endpoint_stats['throttled'],
+                    endpoint_stats['p50'], endpoint_stats['p95']))
+            if play['slowest_tasks']:
+                self._display.display('slowest tasks:')
+                for task in play['slowest_tasks']:
+                    self._display.display('  %s (%s): %d calls, %.2fs' % (
+                        task['task'], task['host'], task['calls'], task['elapsed']))
+
+        path = self.get_option('summary_file')
+        if path:
+            try:
+                with open(os.path.expanduser(path), 'w') as f:
+                    json.dump(summary, f, indent=2)
+            except (IOError, OSError) as e:
+                self._display.warning('Failed to write the Equinix Metal API summary to %s: %s' % (path, to_native(e)))
@@ -17,6 +17,37 @@ class ModuleDocFragment(object):
             required: true
             aliases:
                 - auth_token
+        api_rate_limit:
+            description:
+                - How many API requests per second all the tasks running on this machine with the same API token may send between
+                  them, e.g. to keep many forks from getting the account throttled by the API.
+                - The tasks share the budget through a file locked while it is updated, in C(~/.ansible/tmp/equinix_metal_rate_limit).
+                - If not set, then the value of the METAL_API_RATE_LIMIT environment variable is used, and without it, each task
+                  only slows down when the API throttles it.
+            type: float
+        api_retries:
+            description:
+                - How many times to retry an API request when the API rejects it as rate limited (HTTP 429) or unavailable
+                  (HTTP 503), or when the connection to the API times out.
+                - Requests creating or changing something are not retried when answered with HTTP 502 or 504, since the API may
+                  have processed them. Requests reading or deleting something are.
+                - The delay before a retry doubles every time, or is the one asked for by the API.
+                - If not set, then the value of the METAL_API_RETRIES environment variable is used.
+            type: int
+            default: 3
+        api_metrics:
+            description:
+                - Whether to return the number, the latency and the size of the API requests sent by the task, per endpoint,
+                  in a C(metal_metrics) result.
+                - If not set, then the value of the METAL_API_METRICS environment variable is used.
+            type: bool
+            default: false
+        api_metrics_file:
+            description:
+                - A file to append every API request sent by the task to, as a line of JSON, e.g. to look at the requests
+                  of a whole play. Implies I(api_metrics=true).
+                - If not set, then the value of the METAL_API_METRICS_FILE environment variable is used.
+            type: path
     requirements:
         - "packet-python >= 1.43.1"
     '''
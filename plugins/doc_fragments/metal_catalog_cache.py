@@ -0,0 +1,24 @@
+# Copyright: (c) 2021, Equinix Metal
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+
+class ModuleDocFragment(object):
+    # Standard documentation
+    DOCUMENTATION = r'''
+    options:
+        catalog_cache_ttl:
+            description:
+                - How long (seconds) to use the catalog cached on disk by a previous call without asking the API whether it changed.
+                - Once expired, the cached catalog is revalidated, and only downloaded again if it changed.
+                - Set to C(0) to always download the catalog.
+            type: int
+            default: 600
+        catalog_cache_dir:
+            description:
+                - The directory in which to cache the catalog, per API token and query.
+            type: path
+            default: ~/.ansible/tmp/equinix_metal_catalog
+    '''
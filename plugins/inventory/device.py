@@ -35,6 +35,88 @@ DOCUMENTATION = '''
               - If empty (the default) default this will include all projects.
           type: list
           default: []
+        max_workers:
+          description:
+              - Maximum number of API requests sent concurrently, querying the devices of several projects, or fetching the
+                changed devices of the projects refreshed by I(incremental) refreshes.
+              - With the default of C(1) projects are queried one after another and the first failure aborts the inventory.
+              - With a value greater than C(1), a failure to query one project is reported as a warning and the
+                devices of the remaining projects are still added to the inventory. The results are not cached in that case.
+          type: int
+          default: 1
+        pool_size:
+          description:
+              - Number of keep-alive connections to the Equinix Metal API kept open during an inventory run.
+              - A single connection pool is shared by the project listing and all device listings.
+              - The pool always holds at least I(max_workers) connections.
+          type: int
+          default: 10
+        device_exclude:
+          description:
+              - List of device attributes the API should leave out of the device listings, passed as the C(exclude) query parameter.
+              - Nested attributes can be given in dotted notation, for example C(plan.specs).
+              - The default excludes the attributes that are never turned into host variables, which considerably reduces
+                the size of the API responses for large projects.
+              - Excluded attributes are not available as host variables, nor to I(compose), I(groups) and I(keyed_groups).
+              - Set to an empty list to request the full device payloads.
+          type: list
+          elements: str
+          default:
+              - network_ports
+              - volumes
+              - ssh_keys
+              - provisioning_events
+              - project_lite
+              - customdata
+              - facility.address
+              - facility.features
+              - operating_system.provisionable_on
+              - operating_system.pricing
+              - plan.available_in
+              - plan.pricing
+              - plan.specs
+        incremental:
+          description:
+              - Refresh the inventory incrementally instead of downloading every device of every project.
+              - The devices found in each project are kept in a snapshot in I(snapshot_dir), which unlike the inventory cache does not expire.
+              - On refresh, only the IDs and update times of the devices of a project are listed. Devices that are new or were
+                updated since the snapshot are then fetched one by one, and devices that are gone are dropped.
+              - When more devices of a project changed than there are pages in a full listing of the project, the whole
+                project is downloaded instead.
+              - A snapshot taken with another I(device_exclude) is not used, and every project is downloaded again.
+          type: bool
+          default: false
+        stale_while_revalidate:
+          description:
+              - When the cached inventory has expired, use the devices found by the previous run right away and refresh
+                the cache in the background, instead of waiting for the Equinix Metal API.
+              - The devices found by the previous run are kept in a snapshot in I(snapshot_dir).
+              - The cache is refreshed by a separate python process started in the background, which outlives the current run
+                if needed. Its errors are logged to a C(.log) file named after the cache key in I(snapshot_dir).
+              - Only one such process refreshes the cache at a time, other runs finding the cache expired meanwhile just use
+                the devices of the previous run.
+              - Only used when I(cache) is enabled, with a cache plugin that persists the cache, like C(jsonfile). Refreshing the inventory with the C(refresh_inventory) meta task or C(--flush-cache)
+                always queries the API right away.
+          type: bool
+          default: false
+        max_stale:
+          description:
+              - How long (seconds) after the cached inventory expired the devices of the previous run may still be used by I(stale_while_revalidate).
+              - Older snapshots are ignored and the API is queried right away.
+          type: int
+          default: 3600
+        snapshot_dir:
+          description:
+              - Directory in which the device snapshots used by I(incremental) and I(stale_while_revalidate) are kept.
+          type: path
+          default: ~/.ansible/tmp/equinix_metal_inventory
+        api_metrics_file:
+          description:
+              - A file to append every API request sent by the inventory to, as a line of JSON, like the I(api_metrics_file)
+                option of the modules of this collection, e.g. for the C(equinix.metal.api_metrics) callback plugin.
+          type: path
+          env:
+              - name: METAL_API_METRICS_FILE
     version_added: 1.0.0
 '''
 
@@ -66,16 +148,117 @@ compose:
   ansible_host: (ip_addresses | selectattr('address_family', 'equalto', 4) | selectattr('public', 'equalto', false) | first).address
 '''
 
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from inspect import getfullargspec as getargspec
+except ImportError:
+    from inspect import getargspec
+
 from ansible.errors import AnsibleError, AnsibleParserError
+from ansible.module_utils._text import to_bytes
 from ansible.module_utils import six
+from ansible.module_utils._text import to_native
 from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable, to_safe_group_name
+from ansible.utils.vars import combine_vars
+
+from ansible_collections.equinix.metal.plugins.module_utils.metal import ApiMetrics, map_concurrently, paginate
 
 try:
     import packet
+    from packet.baseapi import ResponseError
+    from ansible_collections.equinix.metal.plugins.module_utils.metal_api import MetalManager, metal_session
     HAS_METAL = True
 except ImportError:
     HAS_METAL = False
 
+# whether the constructed helpers look up the host variables themselves (ansible >= 2.10)
+FETCH_HOSTVARS = 'fetch_hostvars' in getargspec(Constructable._add_host_to_keyed_groups).args
+
+BARE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+JINJA2_LITERALS = frozenset(['true', 'false', 'none', 'True', 'False', 'None'])
+
+SNAPSHOT_VERSION = 3
+
+CACHE_FORMAT_VERSION = 1
+
+# host variables sharing few distinct values across devices, stored once in the cache
+INTERNED_KEYS = frozenset(['billing_cycle', 'bonding_mode', 'facility', 'operating_system', 'plan', 'project', 'state'])
+
+IP_ADDRESS_KEYS = (
+    'address',
+    'address_family',
+    'public',
+    'cidr',
+    'enabled',
+    'gateway',
+    'global_ip',
+    'manageable',
+    'management',
+    'netmask',
+    'network',
+    'tags',
+)
+
+# device attributes left out when listing only the IDs and update times of devices
+DEVICE_STAMP_EXCLUDE = [
+    'actions',
+    'created_by',
+    'customdata',
+    'facility',
+    'hardware_reservation',
+    'ip_addresses',
+    'metro',
+    'network_ports',
+    'operating_system',
+    'plan',
+    'project',
+    'project_lite',
+    'provisioning_events',
+    'sos',
+    'ssh_keys',
+    'storage',
+    'user',
+    'userdata',
+    'volumes',
+]
+DEVICE_STAMP_PER_PAGE = 1000
+# page size of the full device listings, the most the API allows
+DEVICE_PER_PAGE = 1000
+
+# run by _revalidate_in_background in a detached python process, with the
+# directory containing ansible_collections and the inventory source as arguments
+REVALIDATE_SCRIPT = '''
+import sys
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+try:
+    from ansible.plugins.loader import init_plugin_loader
+except ImportError:
+    # ansible-core < 2.15 sets up the collection loader on import
+    init_plugin_loader = None
+from ansible.plugins.loader import inventory_loader
+
+if init_plugin_loader is not None:
+    init_plugin_loader([sys.argv[1]])
+plugin = inventory_loader.get('equinix.metal.device')
+plugin.parse(InventoryData(), DataLoader(), sys.argv[2], cache=False)
+plugin.update_cache_if_changed()
+'''
+
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
 
@@ -89,6 +272,27 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         # credentials
         self.api_token = None
 
+        # HTTP session shared by all API calls of an inventory run
+        self._session = None
+
+        # recorder of the API calls, when api_metrics_file is set
+        self._metrics = None
+
+        # projects which could not be queried during the last _query
+        self._failed_projects = {}
+
+        # devices of every project queried during the last _query
+        self._project_devices = OrderedDict()
+
+        # devices of every project known from the previous run, used by incremental refreshes
+        self._previous_devices = None
+
+        # how many changed devices an incremental refresh of a project fetches at the same time, all of max_workers if None
+        self._device_workers = None
+
+        # whether _compose may look up bare variable names without templating them
+        self._lookup_bare_names = False
+
     def verify_file(self, path):
         '''
             :param loader: an ansible.parsing.dataloader.DataLoader object
@@ -106,14 +310,54 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             :param config_data: contents of the inventory config file
         '''
         self.api_token = self.get_option('api_token')
+        if self.get_option('api_metrics_file'):
+            self._metrics = ApiMetrics(self.get_option('api_metrics_file'), self.NAME)
 
     def _query(self, project_ids):
         '''
             :param project_ids: a list of project ids to query
         '''
+        self._failed_projects = {}
+        self._project_devices = OrderedDict()
+        self._device_workers = None
+        max_workers = self.get_option('max_workers')
+
+        if max_workers <= 1 or len(project_ids) <= 1:
+            devices = []
+            for id in project_ids:
+                project_devices = self._get_devices_by_project(id)
+                self._project_devices[id] = project_devices
+                devices.extend(project_devices)
+
+            return {'equinix_metal': devices}
+
+        workers = min(max_workers, len(project_ids))
+        # the projects share max_workers, and the connections of the session,
+        # with the devices their incremental refreshes fetch
+        self._device_workers = max(1, max_workers // workers)
+        pool = ThreadPool(workers)
+        try:
+            # map() keeps the results in project_ids order, so the inventory is
+            # the same regardless of which project finished first
+            project_results = pool.map(self._get_devices_by_project_safe, project_ids)
+        finally:
+            pool.close()
+            pool.join()
+            self._device_workers = None
+
         devices = []
-        for id in project_ids:
-            devices.extend(self._get_devices_by_project(id))
+        for project_id, (project_devices, error) in zip(project_ids, project_results):
+            if error is not None:
+                self._failed_projects[project_id] = error
+                self.display.warning(
+                    "Failed to query devices of project {0} from Equinix Metal API: {1}".format(project_id, to_native(error))
+                )
+                continue
+            self._project_devices[project_id] = project_devices
+            devices.extend(project_devices)
+
+        if len(self._failed_projects) == len(project_ids):
+            raise AnsibleError("Failed to query devices from Equinix Metal API for all projects")
 
         return {'equinix_metal': devices}
 
@@ -128,24 +372,53 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
             :param hosts: a list of hosts to be added to a group
             :param group: the name of the group to which the hosts belong
         '''
+        # Use constructed if applicable
+        strict = self.get_option('strict')
+        try:
+            use_extra_vars = self.get_option('use_extra_vars')
+        except KeyError:
+            use_extra_vars = False
+        self._lookup_bare_names = not use_extra_vars
+        compose = self.get_option('compose')
+        composed_groups = self.get_option('groups')
+        keyed_groups = self.get_option('keyed_groups')
+
         for host in hosts:
-            hostname = host['hostname']
+            hostname = self.inventory.add_host(host['hostname'], group=group)
 
-            self.inventory.add_host(hostname, group=group)
+            # through set_variable, which validates and tags the values like for any other inventory source
             for hostvar, hostval in host.items():
                 self.inventory.set_variable(hostname, hostvar, hostval)
 
-            # Use constructed if applicable
-            strict = self.get_option('strict')
-
             # Composed variables
-            self._set_composite_vars(self.get_option('compose'), host, hostname, strict=strict)
+            if compose:
+                self._set_composite_vars(compose, host, hostname, strict=strict)
+
+            if not composed_groups and not keyed_groups:
+                continue
+
+            if FETCH_HOSTVARS:
+                # look up the host variables once instead of once per group
+                variables = combine_vars(host, self.inventory.get_host(hostname).get_vars())
+                kwargs = {'fetch_hostvars': False}
+            else:
+                variables = host
+                kwargs = {}
 
             # Complex groups based on jinja2 conditionals, hosts that meet the conditional are added to group
-            self._add_host_to_composed_groups(self.get_option('groups'), host, hostname, strict=strict)
+            if composed_groups:
+                self._add_host_to_composed_groups(composed_groups, variables, hostname, strict=strict, **kwargs)
 
             # Create groups based on variable values and add the corresponding hosts to it
-            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), host, hostname, strict=strict)
+            if keyed_groups:
+                self._add_host_to_keyed_groups(keyed_groups, variables, hostname, strict=strict, **kwargs)
+
+    def _compose(self, template, variables, *args, **kwargs):
+        # bare variable names, like most keyed_groups keys, need no jinja2 compilation
+        if (self._lookup_bare_names and isinstance(template, six.string_types)
+                and BARE_NAME_RE.match(template) and template not in JINJA2_LITERALS and template in variables):
+            return variables[template]
+        return super(InventoryModule, self)._compose(template, variables, *args, **kwargs)
 
     def parse(self, inventory, loader, path, cache=True):
 
@@ -170,25 +443,212 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         cache_needs_update = False
         if cache:
             try:
-                results = self._cache[cache_key]
+                results = decode_results(self._cache[cache_key])
             except KeyError:
                 # if cache expires or cache file doesn't exist
                 cache_needs_update = True
 
-        if not cache or cache_needs_update:
-            project_ids = self._get_project_ids()
-            results = self._query(project_ids)
+        revalidating = False
+        if cache_needs_update and self.get_option('stale_while_revalidate'):
+            results = self._get_stale_results(cache_key)
+            revalidating = results is not None
+
+        if revalidating:
+            self._revalidate_in_background(path, cache_key)
+        elif not cache or cache_needs_update:
+            results = self._refresh(cache_key)
 
         self._populate(results)
 
         # If the cache has expired/doesn't exist or if refresh_inventory/flush cache is used
         # when the user is using caching, update the cached inventory
+        if revalidating:
+            # the background refresh updates the cache once it is done
+            return
+
+        if self._failed_projects:
+            # do not keep an incomplete inventory around until the cache expires
+            return
+
         if cache_needs_update or (not cache and self.get_option('cache')):
-            self._cache[cache_key] = results
+            self._cache[cache_key] = encode_results(results)
+
+    def _refresh(self, cache_key):
+        '''
+            :param cache_key: the cache key of the inventory source
+            :return the inventory queried from the Equinix Metal API
+        '''
+        incremental = self.get_option('incremental')
+        if incremental:
+            self._previous_devices = self._load_snapshot(cache_key).get('projects')
+
+        self._session = metal_session(max(self.get_option('pool_size'), self.get_option('max_workers')))
+        try:
+            project_ids = self._get_project_ids()
+            results = self._query(project_ids)
+        finally:
+            self._session.close()
+            self._session = None
+            self._previous_devices = None
+
+        if incremental or self.get_option('stale_while_revalidate'):
+            self._save_snapshot(cache_key)
+
+        return results
+
+    def _get_stale_results(self, cache_key):
+        '''
+            :param cache_key: the cache key of the inventory source
+            :return the inventory of the previous run, or None if there is none recent enough
+        '''
+        snapshot = self._load_snapshot(cache_key)
+        if not snapshot:
+            return None
+
+        age = time.time() - snapshot['timestamp']
+        if age > self.get_option('cache_timeout') + self.get_option('max_stale'):
+            self.display.vvv("equinix_metal inventory: snapshot is {0:.0f} seconds old, not using it".format(age))
+            return None
+
+        project_ids = self.get_option('projects') or list(snapshot['projects'])
+        if any(project_id not in snapshot['projects'] for project_id in project_ids):
+            return None
+
+        devices = []
+        for project_id in project_ids:
+            devices.extend(snapshot['projects'][project_id])
+        return {'equinix_metal': devices}
+
+    def _revalidate_in_background(self, path, cache_key):
+        '''
+            :param path: the path to the inventory config file
+            :param cache_key: the cache key of the inventory source
+            :return the process refreshing the inventory
+        '''
+        # The refresh runs in its own detached process, which reads the inventory
+        # config again and updates the snapshot and the cache like --flush-cache
+        # would. Nothing is shared with this process, which may fork its workers
+        # or exit before the refresh is done, but a lock on a file of the cache
+        # key, which the refreshing process inherits and holds until it exits.
+        # Runs finding it locked leave the refresh to that process.
+        lock = self._lock_revalidation(cache_key)
+        if lock is False:
+            self.display.vvv("equinix_metal inventory: the cache is already being refreshed in the background")
+            return None
+
+        # .../ansible_collections/equinix/metal/plugins/inventory/device.py
+        collections_root = os.path.abspath(__file__)
+        for _ in range(6):
+            collections_root = os.path.dirname(collections_root)
+
+        log_path = os.path.join(self.get_option('snapshot_dir'), '{0}.log'.format(cache_key))
+        try:
+            log = open(log_path, 'ab')
+        except (IOError, OSError):
+            log = open(os.devnull, 'wb')
+
+        if six.PY3:
+            kwargs = {'start_new_session': True, 'close_fds': True, 'pass_fds': () if lock is None else (lock.fileno(),)}
+        else:
+            # file descriptors are inherited by default with python 2
+            kwargs = {'preexec_fn': os.setsid, 'close_fds': lock is None}
+        try:
+            process = subprocess.Popen(
+                [sys.executable, '-c', REVALIDATE_SCRIPT, collections_root, os.path.abspath(path)],
+                stdin=open(os.devnull, 'rb'), stdout=log, stderr=log, **kwargs
+            )
+        except (IOError, OSError) as e:
+            self.display.warning("Failed to refresh the equinix_metal inventory in the background: {0}".format(to_native(e)))
+            return None
+        finally:
+            log.close()
+            if lock:
+                lock.close()
+
+        self.display.vvv("equinix_metal inventory: refreshing the cache in process {0}, logging to {1}".format(process.pid, log_path))
+        return process
+
+    def _lock_revalidation(self, cache_key):
+        '''
+            :param cache_key: the cache key of the inventory source
+            :return the lock file of the background refreshes of cache_key, locked, False if another process holds the lock,
+                    or None if it cannot be locked
+        '''
+        if fcntl is None:
+            return None
+        lock_path = os.path.join(self.get_option('snapshot_dir'), '{0}.lock'.format(cache_key))
+        try:
+            lock = open(lock_path, 'a')
+        except (IOError, OSError) as e:
+            self.display.debug("Failed to open equinix_metal inventory lock {0}: {1}".format(lock_path, to_native(e)))
+            return None
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            lock.close()
+            return False
+        return lock
+
+    def _snapshot_path(self, cache_key):
+        return os.path.join(self.get_option('snapshot_dir'), '{0}.json'.format(cache_key))
+
+    def _load_snapshot(self, cache_key):
+        '''
+            :param cache_key: the cache key of the inventory source
+            :return The snapshot of the previous run, with the device dictionaries of every project, empty if unknown
+        '''
+        path = self._snapshot_path(cache_key)
+        try:
+            with open(path, 'rb') as f:
+                snapshot = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            return {}
+
+        if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+            self.display.debug("Ignoring equinix_metal inventory snapshot {0} in an unknown format".format(path))
+            return {}
+
+        if snapshot.get('device_exclude') != sorted(self.get_option('device_exclude') or []):
+            # the devices of the snapshot do not have the attributes of the current listings
+            self.display.vvv("equinix_metal inventory: ignoring snapshot {0} taken with another device_exclude".format(path))
+            return {}
+
+        snapshot['projects'] = OrderedDict(decode_device_lists(snapshot['projects']))
+        return snapshot
+
+    def _save_snapshot(self, cache_key):
+        '''
+            :param cache_key: the cache key of the inventory source
+        '''
+        projects = OrderedDict(self._project_devices)
+        # keep what is known about the projects which could not be queried this time
+        previous = self._load_snapshot(cache_key).get('projects', {})
+        for project_id in self._failed_projects:
+            if project_id in previous:
+                projects[project_id] = previous[project_id]
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'timestamp': time.time(),
+            'device_exclude': sorted(self.get_option('device_exclude') or []),
+            'projects': encode_device_lists(list(projects.items())),
+        }
+
+        path = self._snapshot_path(cache_key)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), 0o700)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(to_bytes(json.dumps(snapshot)))
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            self.display.warning("Failed to write equinix_metal inventory snapshot {0}: {1}".format(path, to_native(e)))
 
     def _connect(self):
         ''' create connection to api server'''
-        manager = packet.Manager(auth_token=self.api_token, consumer_token="ansible-equinix-metal-inventory")
+        manager = MetalManager(auth_token=self.api_token, consumer_token="ansible-equinix-metal-inventory", session=self._session,
+                               metrics=self._metrics)
         return manager
 
     def _get_project_ids(self):
@@ -208,21 +668,122 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
         return project_ids
 
     def _get_devices_by_project(self, project_id):
+        '''
+           :param project_id: a project id in which to discover devices
+           :return A list of device dictionaries
+        '''
+        if self._previous_devices and project_id in self._previous_devices:
+            return self._refresh_devices_by_project(project_id, self._previous_devices[project_id])
+
+        return self._list_devices_by_project(project_id)
+
+    def _device_params(self):
+        params = {}
+        exclude = self.get_option('device_exclude')
+        if exclude:
+            params['exclude'] = ','.join(exclude)
+        return params
+
+    def _excluded_keys(self):
+        '''
+           :return The device attributes left out of the listings by device_exclude, which are not host variables
+        '''
+        return frozenset(key for key in self.get_option('device_exclude') or [] if '.' not in key)
+
+    def _list_devices_by_project(self, project_id):
         '''
            :param project_id: a project id in which to discover devices
            :return A list of device dictionaries
         '''
         try:
             manager = self._connect()
-            devices = manager.list_all_devices(project_id=project_id)
-            return [self._get_host_info_dict_from_device(device) for device in devices]
+            params = dict(self._device_params(), per_page=DEVICE_PER_PAGE)
+            devices = paginate(manager, 'projects/%s/devices' % project_id, 'devices', params=params)
+            excluded = self._excluded_keys()
+            return [self._get_host_info_dict_from_device(packet.Device(device, manager), excluded) for device in devices]
         except Exception as e:
             raise AnsibleError("Failed to query devices from Equinix Metal API", orig_exc=e)
 
-    def _get_host_info_dict_from_device(self, device):
+    def _refresh_devices_by_project(self, project_id, previous_devices):
+        '''
+           :param project_id: a project id in which to discover devices
+           :param previous_devices: the device dictionaries of the project known from the previous run
+           :return A list of device dictionaries
+        '''
+        previous = dict((device.get('id'), device) for device in previous_devices)
+
+        try:
+            manager = self._connect()
+            stamps = list(paginate(
+                manager,
+                'projects/%s/devices' % project_id,
+                'devices',
+                params={'exclude': ','.join(DEVICE_STAMP_EXCLUDE), 'per_page': DEVICE_STAMP_PER_PAGE},
+            ))
+        except Exception as e:
+            raise AnsibleError("Failed to query devices from Equinix Metal API", orig_exc=e)
+
+        changed = [stamp['id'] for stamp in stamps
+                   if stamp['id'] not in previous or stamp.get('updated_at') != previous[stamp['id']].get('updated_at')]
+        # one request per changed device, against one per page for a full listing
+        if len(changed) > (len(stamps) + DEVICE_PER_PAGE - 1) // DEVICE_PER_PAGE:
+            return self._list_devices_by_project(project_id)
+
+        self.display.vvv("equinix_metal inventory: {0} of {1} devices of project {2} changed".format(len(changed), len(stamps), project_id))
+
+        params = self._device_params()
+
+        def fetch(device_id):
+            try:
+                # a manager per call, managers keeping per call state
+                return self._connect().call_api('devices/%s' % device_id, params=params)
+            except ResponseError as e:
+                if e.response.status_code == 404:
+                    # deleted since it was listed
+                    return None
+                raise
+
+        updated = {}
+        deleted = set()
+        excluded = self._excluded_keys()
+        workers = self._device_workers or self.get_option('max_workers')
+        for device_id, (device, error) in zip(changed, map_concurrently(fetch, changed, workers)):
+            if error is not None:
+                raise AnsibleError("Failed to query device {0} from Equinix Metal API".format(device_id), orig_exc=error)
+            if device is None:
+                deleted.add(device_id)
+            else:
+                updated[device_id] = self._get_host_info_dict_from_device(packet.Device(device, manager), excluded)
+
+        devices = []
+        for stamp in stamps:
+            if stamp['id'] in deleted:
+                continue
+            if stamp['id'] in updated:
+                devices.append(updated[stamp['id']])
+            elif stamp['id'] in previous:
+                devices.append(previous[stamp['id']])
+        return devices
+
+    def _get_devices_by_project_safe(self, project_id):
+        '''
+           :param project_id: a project id in which to discover devices
+           :return A tuple of the list of device dictionaries and the error raised while querying them, if any
+        '''
+        try:
+            return self._get_devices_by_project(project_id), None
+        except Exception as e:
+            return [], e
+
+    def _get_host_info_dict_from_device(self, device, excluded=None):
+        if excluded is None:
+            excluded = self._excluded_keys()
         device_vars = {}
         device.ip_addresses
         for key in vars(device):
+            if key in excluded:
+                # missing from the payload, not empty
+                continue
             value = getattr(device, key)
             key = to_safe_group_name(key)
 
@@ -249,25 +810,105 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                 device_vars[key] = []
 
                 for addr in value:
-                    device_vars[key].append(
-                        {
-                            'address': addr['address'],
-                            'address_family': addr['address_family'],
-                            'public': addr['public'],
-                            'cidr': addr['cidr'],
-                            'enabled': addr['enabled'],
-                            'gateway': addr['gateway'],
-                            'global_ip': addr['global_ip'],
-                            'manageable': addr['manageable'],
-                            'management': addr['management'],
-                            'netmask': addr['netmask'],
-                            'network': addr['network'],
-                            'tags': addr['tags'],
-                        }
-                    )
+                    device_vars[key].append(dict((addr_key, addr[addr_key]) for addr_key in IP_ADDRESS_KEYS))
             elif key == 'tags':
                 device_vars[key] = value
             else:
                 pass
 
         return device_vars
+
+
+def encode_device_lists(device_lists):
+    '''
+        :param device_lists: a list of (name, list of device dictionaries) pairs
+        :return A compact representation of the device lists, suitable for JSON
+
+        Devices are stored as rows of values next to a shared list of their
+        keys, the values of INTERNED_KEYS are stored once in a string table and
+        IP addresses are stored as rows of IP_ADDRESS_KEYS values.
+    '''
+    strings = []
+    string_index = {}
+    shapes = []
+    shape_index = {}
+    lists = []
+
+    for name, devices in device_lists:
+        rows = []
+        for device in devices:
+            shape = tuple(device)
+            if shape not in shape_index:
+                shape_index[shape] = len(shapes)
+                shapes.append(list(shape))
+
+            row = [shape_index[shape]]
+            for key, value in device.items():
+                if key in INTERNED_KEYS:
+                    if isinstance(value, six.string_types):
+                        if value not in string_index:
+                            string_index[value] = len(strings)
+                            strings.append(value)
+                        value = string_index[value]
+                    else:
+                        value = [value]
+                elif key == 'ip_addresses' and isinstance(value, list):
+                    value = [[addr[addr_key] for addr_key in IP_ADDRESS_KEYS]
+                             if isinstance(addr, dict) and tuple(addr) == IP_ADDRESS_KEYS else addr
+                             for addr in value]
+                row.append(value)
+            rows.append(row)
+        lists.append([name, rows])
+
+    return {
+        'format_version': CACHE_FORMAT_VERSION,
+        'strings': strings,
+        'shapes': shapes,
+        'ip_address_keys': list(IP_ADDRESS_KEYS),
+        'lists': lists,
+    }
+
+
+def decode_device_lists(data):
+    '''
+        :param data: device lists encoded by encode_device_lists
+        :return A list of (name, list of device dictionaries) pairs
+    '''
+    strings = data['strings']
+    shapes = data['shapes']
+    ip_address_keys = data['ip_address_keys']
+
+    device_lists = []
+    for name, rows in data['lists']:
+        devices = []
+        for row in rows:
+            device = {}
+            for key, value in zip(shapes[row[0]], row[1:]):
+                if key in INTERNED_KEYS:
+                    value = strings[value] if isinstance(value, int) else value[0]
+                elif key == 'ip_addresses' and isinstance(value, list):
+                    value = [dict(zip(ip_address_keys, addr)) if isinstance(addr, list) else addr for addr in value]
+                device[key] = value
+            devices.append(device)
+        device_lists.append((name, devices))
+
+    return device_lists
+
+
+def encode_results(results):
+    '''
+        :param results: the inventory, a dictionary of lists of device dictionaries per group
+        :return The inventory in the compact form stored in the inventory cache
+    '''
+    return encode_device_lists(list(results.items()))
+
+
+def decode_results(data):
+    '''
+        :param data: the inventory as stored in the inventory cache
+        :return The inventory, a dictionary of lists of device dictionaries per group
+    '''
+    if data.get('format_version') != CACHE_FORMAT_VERSION or 'lists' not in data:
+        # cached by a version of the plugin storing the plain inventory
+        return data
+    return OrderedDict(decode_device_lists(data))
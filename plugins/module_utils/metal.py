@@ -5,20 +5,464 @@
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
+import hashlib
+import json
+import os
+import random
 import re
+import tempfile
+import threading
+import time
+import traceback
 import uuid
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
-HAS_METAL_SDK = True
 try:
-    import packet
+    import fcntl
 except ImportError:
-    HAS_METAL_SDK = False
+    fcntl = None
 
-from ansible.module_utils.basic import AnsibleModule, env_fallback
+from ansible.module_utils.basic import AnsibleModule, env_fallback, missing_required_lib
+from ansible.module_utils._text import to_bytes
+from ansible.module_utils.six import binary_type, text_type
+
+
+def is_importable(name):
+    """Whether the top level module name can be imported, without importing it"""
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        # Python 2
+        import imp
+        try:
+            imp.find_module(name)
+        except ImportError:
+            return False
+        return True
+    return find_spec(name) is not None
+
+
+# packet-python and requests take longer to import than most modules take to
+# validate their arguments, so they are only imported with metal_api, by
+# import_metal_sdk(), once the first API client is created
+HAS_METAL_SDK = is_importable('packet') and is_importable('requests')
 
 NAME_RE = r'({0}|{0}{1}*{0})'.format(r'[a-zA-Z0-9]', r'[a-zA-Z0-9\-]')
 HOSTNAME_RE = r'({0}\.)*{0}$'.format(NAME_RE)
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CATALOG_CACHE_DIR = '~/.ansible/tmp/equinix_metal_catalog'
+DEFAULT_CATALOG_CACHE_TTL = 600
+# capacity changes a lot faster than the catalogs
+CAPACITY_CACHE_TTL = 60
+DEFAULT_PER_PAGE = 100
+
+# how the events of a project are read by DeviceEventsRefresh
+EVENTS_PER_PAGE = 100
+MAX_EVENTS_READ = 1000
+FULL_REFRESH_INTERVAL = 60
+
+# states of a device batch once the API processed it
+BATCH_PROCESSED_STATES = ('completed', 'failed')
+
+DEVICE_HREF_RE = re.compile(r'/devices/([^/]+)$')
+PROJECT_HREF_RE = re.compile(r'/projects/([^/]+)$')
+
+# responses telling that the request was not processed and may be sent again
+UNPROCESSED_STATUS_CODES = (429, 503)
+# responses after which an idempotent request may be sent again
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# how MetalManager paces and retries its requests, see RequestScheduler
+MAX_REQUEST_RETRIES = 3
+MIN_REQUEST_RATE = 0.5
+REQUEST_BURST = 10
+REQUEST_RATE_WINDOW = 10.0
+IDEMPOTENT_METHODS = ('GET', 'DELETE')
+DEFAULT_RATE_LIMIT_DIR = '~/.ansible/tmp/equinix_metal_rate_limit'
+
+# upper bounds (seconds) of the latency histogram buckets of ApiMetrics,
+# the last bucket counting the slower calls
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ENDPOINT_ID_RE = re.compile(r'(?<=/)[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)')
+
+# tags the requests ApiMetrics appends to api_metrics_file from this process,
+# e.g. those of the inventory of the running playbook, unlike a pid never reused
+API_METRICS_RUN_ID = uuid.uuid4().hex
+# where this process first appended a request to each api_metrics_file (by real path)
+API_METRICS_FILE_OFFSETS = {}
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait given by a Retry-After header, if any"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler(object):
+    """
+    Pace the API requests of all the managers using the same API token.
+
+    Requests are sent right away until the API starts throttling them.  A
+    token bucket then limits them to a rate, starting from half of the rate
+    of the requests sent in the last REQUEST_RATE_WINDOW seconds, halved
+    again on every other 429 response and raised by one request per second
+    every second otherwise.  No request is sent either while the API asked
+    to wait, with a Retry-After header or rate limit headers telling that no
+    request remains.
+    """
+
+    _schedulers = {}
+    _schedulers_lock = threading.Lock()
+
+    def __init__(self, burst=REQUEST_BURST, budget=None):
+        self.rate = None
+        self.burst = burst
+        self.budget = budget
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._paused_until = 0.0
+        self._sent = deque(maxlen=1000)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_token(cls, auth_token, shared_rate=None):
+        """
+        Return the scheduler of the process for the API token, sharing a
+        budget of shared_rate requests per second with the other processes
+        of this machine if set (see SharedRequestBudget).
+        """
+        key = hashlib.sha256(to_bytes(auth_token or '')).hexdigest()
+        with cls._schedulers_lock:
+            if key not in cls._schedulers:
+                cls._schedulers[key] = cls()
+            scheduler = cls._schedulers[key]
+            if shared_rate and shared_rate > 0 and scheduler.budget is None and fcntl is not None:
+                path = os.path.join(os.path.expanduser(DEFAULT_RATE_LIMIT_DIR), key)
+                scheduler.budget = SharedRequestBudget(path, shared_rate)
+            return scheduler
+
+    def acquire(self):
+        """Wait until a request may be sent"""
+        with self._lock:
+            now = time.time()
+            wait = self._paused_until - now
+            if self.rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate) - 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            self._updated = now
+            self._sent.append(now + max(0.0, wait))
+        if wait > 0:
+            time.sleep(wait)
+        if self.budget is not None:
+            self.budget.acquire()
+
+    def pause(self, delay):
+        """Send no request for delay seconds"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.time() + delay)
+        if self.budget is not None:
+            self.budget.pause(delay)
+
+    def throttled(self, delay):
+        """Slow down after a 429 response, and send no request for delay seconds"""
+        with self._lock:
+            now = time.time()
+            if self.rate is None:
+                recent = [t for t in self._sent if t > now - REQUEST_RATE_WINDOW]
+                self.rate = len(recent) / REQUEST_RATE_WINDOW
+                self._tokens = 0.0
+            self.rate = max(MIN_REQUEST_RATE, self.rate / 2)
+            self._paused_until = max(self._paused_until, now + delay)
+        if self.budget is not None:
+            self.budget.pause(delay)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate:
+                self.rate += 1.0 / self.rate
+
+    def observe(self, resp):
+        """Pause when the rate limit headers of resp tell that no request remains"""
+        try:
+            remaining = int(resp.headers.get('X-RateLimit-Remaining'))
+            reset = float(resp.headers.get('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            return
+        if remaining <= 0:
+            # either a timestamp or a number of seconds
+            self.pause(reset - time.time() if reset > 1e9 else reset)
+
+
+class SharedRequestBudget(object):
+    """
+    A token bucket shared by the processes of this machine, e.g. Ansible
+    forks, kept in a file locked while it is updated: at most rate requests
+    per second between them all on average, in bursts of up to burst
+    requests, and none while the API asked one of them to wait.
+
+    A request taken from an empty bucket is owed, so that the processes are
+    served in turn rather than all at once when the bucket refills. The
+    budget is not enforced when its file cannot be used.
+    """
+
+    def __init__(self, path, rate, burst=REQUEST_BURST):
+        self.path = path
+        self.rate = float(rate)
+        self.burst = burst
+
+    def acquire(self):
+        """Wait until a request may be sent"""
+        wait = self._update(reserve=True)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, delay):
+        """Send no request from any process for delay seconds"""
+        self._update(paused_until=time.time() + delay)
+
+    def _update(self, reserve=False, paused_until=0.0):
+        try:
+            return self._update_file(reserve, paused_until)
+        except (IOError, OSError):
+            return 0.0
+
+    def _update_file(self, reserve, paused_until):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError:
+                # created by another process meanwhile
+                pass
+
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.load(f)
+                except ValueError:
+                    state = {}
+                now = time.time()
+                tokens = min(self.burst, state.get('tokens', self.burst) + (now - state.get('updated', now)) * self.rate)
+                paused_until = max(state.get('paused_until', 0.0), paused_until)
+                wait = 0.0
+                if reserve:
+                    tokens -= 1
+                    wait = max(paused_until - now, -tokens / self.rate)
+                f.seek(0)
+                f.truncate()
+                json.dump({'tokens': tokens, 'updated': now, 'paused_until': paused_until}, f)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+
+class ApiMetrics(object):
+    """
+    Count the API requests sent by the managers of a module run: calls,
+    errors, retries, 429 responses, bytes sent and received and a latency
+    histogram per endpoint, endpoints being the method and the path of the
+    requests with the IDs replaced by ``{id}``.
+
+    Every request is also appended as a JSON line to the file at path, if
+    given, tagged with the module name, process and API_METRICS_RUN_ID, so
+    that the requests of a whole play can be looked at together.
+    """
+
+    def __init__(self, path=None, module_name=None):
+        self.path = path
+        self.module_name = module_name
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, type, method, status, elapsed, bytes_sent=0, bytes_received=0, attempt=0):
+        endpoint = '%s %s' % (type, ENDPOINT_ID_RE.sub('{id}', '/' + method.split('?')[0].strip('/')))
+        bucket = len([b for b in LATENCY_BUCKETS if elapsed > b])
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'calls': 0, 'errors': 0, 'retries': 0, 'throttled': 0, 'bytes_sent': 0, 'bytes_received': 0,
+                'elapsed': 0.0, 'max_elapsed': 0.0, 'latency_histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+            })
+            stats['calls'] += 1
+            stats['errors'] += status is None or status >= 400
+            stats['retries'] += attempt > 0
+            stats['throttled'] += status == 429
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['elapsed'] += elapsed
+            stats['max_elapsed'] = max(stats['max_elapsed'], elapsed)
+            stats['latency_histogram'][bucket] += 1
+
+        if self.path:
+            self._emit({'time': time.time(), 'module': self.module_name, 'pid': os.getpid(), 'run': API_METRICS_RUN_ID,
+                        'endpoint': endpoint,
+                        'status': status, 'elapsed': elapsed, 'bytes_sent': bytes_sent,
+                        'bytes_received': bytes_received, 'attempt': attempt})
+
+    def as_dict(self):
+        with self._lock:
+            endpoints = dict((k, dict(v, latency_histogram=list(v['latency_histogram'])))
+                             for k, v in self.endpoints.items())
+        return {
+            'calls': sum(e['calls'] for e in endpoints.values()),
+            'elapsed': sum(e['elapsed'] for e in endpoints.values()),
+            'latency_buckets': list(LATENCY_BUCKETS),
+            'endpoints': endpoints,
+        }
+
+    def _emit(self, record):
+        # a failure to write the metrics must not fail the module
+        try:
+            with open(self.path, 'a') as f:
+                API_METRICS_FILE_OFFSETS.setdefault(os.path.realpath(self.path), f.tell())
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+        except (IOError, OSError):
+            pass
+
+
+def body_size(body):
+    """Length of a request or response body, if known"""
+    if isinstance(body, (binary_type, text_type)):
+        return len(to_bytes(body))
+    return 0
+
+
+def import_metal_sdk(module=None):
+    """
+    Import and return the metal_api module_utils, and with them packet-python
+    and requests.  When they cannot be imported, fail module if given.
+    """
+    try:
+        from ansible_collections.equinix.metal.plugins.module_utils import metal_api
+    except ImportError:
+        if module is None:
+            raise
+        module.fail_json(msg=missing_required_lib('packet-python'), exception=traceback.format_exc())
+    return metal_api
+
+
+class CatalogCache(object):
+    """
+    A cache of API responses on disk, for catalogs changing rarely, such as
+    the plans or the operating systems.
+
+    Responses are kept per API token (hashed) and query.  They are served
+    from the disk for ttl seconds, then revalidated with their ETag or
+    Last-Modified header, so an unchanged catalog is not downloaded again.
+
+    :param directory: the directory holding the cached responses
+    :param ttl: how long (seconds) to serve a response without revalidating it
+    """
+
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def get(self, manager, method, params=None):
+        path = self._path(manager.auth_token, method, params)
+        entry = self._load(path)
+        if entry is not None and time.time() - entry['stored_at'] < self.ttl:
+            return entry['data']
+
+        if entry is None:
+            data, etag, last_modified = manager.get_if_modified(method, params)
+        else:
+            data, etag, last_modified = manager.get_if_modified(method, params, entry.get('etag'),
+                                                                entry.get('last_modified'))
+            if data is None:
+                data = entry['data']
+
+        self._store(path, {'stored_at': time.time(), 'etag': etag, 'last_modified': last_modified, 'data': data})
+        return data
+
+    def _path(self, auth_token, method, params):
+        token_hash = hashlib.sha256(to_bytes(auth_token or '')).hexdigest()
+        key = hashlib.sha256(to_bytes(json.dumps([token_hash, method, params or {}], sort_keys=True))).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            entry['stored_at'] = float(entry['stored_at'])
+            return entry
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _store(self, path, entry):
+        # a failure to cache must not fail the module
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, 0o700)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(entry, f)
+                os.rename(tmp_path, path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError, TypeError, ValueError):
+            pass
+
+
+class CatalogIndex(object):
+    """
+    Which plans are available in which facilities, and which operating
+    systems are provisionable on which plans, as listed by the catalogs.
+    Plans are indexed by slug, name and ID, operating systems by slug and
+    ID, facilities by code.
+
+    The public catalogs do not list everything a project may use, e.g. the
+    plans of its reservations, so a plan or an operating system missing
+    from them is reported apart, by unknown(), rather than as a problem.
+    """
+
+    def __init__(self, plans, operating_systems):
+        self.plan_slugs = {}
+        self.plan_facilities = {}
+        for plan in plans:
+            for key in (plan.slug, plan.name, plan.id):
+                if key:
+                    self.plan_slugs[key] = plan.slug
+            self.plan_facilities[plan.slug] = set(f.get('code') if isinstance(f, dict) else f for f in plan.available_in or [])
+        self.os_plans = {}
+        for operating_system in operating_systems:
+            for key in (operating_system.slug, getattr(operating_system, 'id', None)):
+                if key:
+                    self.os_plans[key] = set(operating_system.provisionable_on or [])
+
+    def unknown(self, plan, operating_system):
+        """Return the descriptions of plan and operating_system if the catalogs do not list them"""
+        unknown = []
+        if plan not in self.plan_slugs:
+            unknown.append("plan {0}".format(plan))
+        if operating_system not in self.os_plans:
+            unknown.append("operating system {0}".format(operating_system))
+        return unknown
+
+    def problems(self, plan, operating_system, facility=None):
+        """
+        Return why devices of plan, operating_system and facility cannot be
+        created according to the catalogs, if they cannot.  Whatever the
+        catalogs do not list is not checked.
+        """
+        problems = []
+        slug = self.plan_slugs.get(plan)
+        if slug is not None and facility and facility != 'any' and facility not in self.plan_facilities[slug]:
+            problems.append("plan {0} is not available in facility {1}".format(plan, facility))
+        os_plans = self.os_plans.get(operating_system)
+        if slug is not None and os_plans and slug not in os_plans:
+            problems.append("operating system {0} is not provisionable on plan {1}".format(operating_system, plan))
+        return problems
+
 
 class AnsibleMetalModule(object):
     """An ansible module class for Equinix Metal modules
@@ -35,6 +479,7 @@ class AnsibleMetalModule(object):
         "default_args": True,
         "project_id_arg": True,
         "project_id_required": True,
+        "catalog_cache_arg": False,
         "module_class": AnsibleModule
     }
 
@@ -63,33 +508,159 @@ class AnsibleMetalModule(object):
                 pass
             kwargs["argument_spec"] = argument_spec_full
 
+        if local_settings["catalog_cache_arg"]:
+            argument_spec_full = metal_catalog_cache_argument_spec()
+            try:
+                argument_spec_full.update(kwargs["argument_spec"])
+            except (TypeError, NameError):
+                pass
+            kwargs["argument_spec"] = argument_spec_full
+
         self._module = AnsibleMetalModule.default_settings["module_class"](**kwargs)
 
         self.check_mode = self._module.check_mode
         self._diff = self._module._diff
         self._name = self._module._name
+        self.metrics = None
+        self._metal_conn = None
+        # how many times the API clients retry a request, see MetalManager
+        self.max_retries = MAX_REQUEST_RETRIES
+        if self.params.get('api_retries') is not None:
+            self.max_retries = self.params.get('api_retries')
 
         if not HAS_METAL_SDK:
             self.fail_json(msg='packet-python required for this module')
 
         if local_settings["default_args"]:
-            self.metal_conn = packet.Manager(auth_token=self.params.get('api_token'))
+            if self.params.get('api_metrics') or self.params.get('api_metrics_file'):
+                self.metrics = ApiMetrics(self.params.get('api_metrics_file'), self._name)
+
+    @property
+    def metal_conn(self):
+        """
+        The API client, only created (and the SDK imported) by the first API
+        call, so that a module exiting before calling the API, e.g. in check
+        mode, does not pay for it.
+        """
+        if self._metal_conn is None:
+            if not self.settings["default_args"]:
+                raise AttributeError("metal_conn requires the default arguments of AnsibleMetalModule")
+            metal_api = import_metal_sdk(self)
+            scheduler = RequestScheduler.for_token(self.params.get('api_token'),
+                                                   shared_rate=self.params.get('api_rate_limit'))
+            self._metal_conn = metal_api.MetalManager(auth_token=self.params.get('api_token'), scheduler=scheduler,
+                                                      metrics=self.metrics, max_retries=self.max_retries)
+        return self._metal_conn
+
+    def get_catalog(self, method, params=None, max_ttl=None):
+        """
+        GET method through the catalog cache, when the module has the
+        catalog cache options and catalog_cache_ttl is positive, caching the
+        response for max_ttl seconds at most.
+        """
+        ttl = self.params.get('catalog_cache_ttl')
+        if ttl and max_ttl is not None:
+            ttl = min(ttl, max_ttl)
+        if not ttl or ttl <= 0:
+            return self.metal_conn.call_api(method, params=params)
+        cache = CatalogCache(os.path.expanduser(self.params.get('catalog_cache_dir')), ttl)
+        return cache.get(self.metal_conn, method, params)
+
+    def list_plans(self, params=None):
+        import packet
+        return [packet.Plan(p) for p in self.get_catalog('plans', params)['plans']]
 
-    def get_devices(self):
+    def list_operating_systems(self, params=None):
+        import packet
+        operating_systems = []
+        for data in self.get_catalog('operating-systems', params)['operating_systems']:
+            operating_system = packet.OperatingSystem(data)
+            # not kept by packet-python, but devices may be created with it
+            operating_system.id = data.get('id')
+            operating_systems.append(operating_system)
+        return operating_systems
+
+    def list_facilities(self, params=None):
+        import packet
+        return [packet.Facility(f) for f in self.get_catalog('facilities', params)['facilities']]
+
+    def get_capacity(self):
+        return self.get_catalog('capacity', max_ttl=CAPACITY_CACHE_TTL)['capacity']
+
+    def get_catalog_index(self):
+        # the same queries as the info modules, to share their cache entries
+        return CatalogIndex(self.list_plans(params={'include': 'available_in'}),
+                            self.list_operating_systems(params={'include': 'available_in'}))
+
+    def get_devices(self, **kwargs):
+        return list(self.iter_devices(**kwargs))
+
+    def iter_devices(self, per_page=DEFAULT_PER_PAGE, manager=None, **filters):
+        """
+        Iterate over the devices of the project, fetching a page of per_page
+        devices only when the previous one has been consumed, so that callers
+        looking for particular devices can stop early.  Any other keyword
+        argument is passed to the API as a filter, e.g. search='hostname'.
+        The pages are requested with manager, metal_conn by default, which
+        must not be used by another thread meanwhile.
+        """
+        import packet
+
+        manager = manager or self.metal_conn
         project_id = self.params.get('project_id')
         if not is_valid_uuid(project_id):
             raise Exception("Project ID {0} does not seem to be valid".format(project_id))
 
-        return self.metal_conn.list_all_devices(project_id)
+        params = dict(filters)
+        if per_page:
+            params['per_page'] = per_page
+        return (packet.Device(device, manager)
+                for device in paginate(manager, 'projects/%s/devices' % project_id, 'devices', params=params))
+
+    def new_manager(self):
+        """
+        Return a new manager for the same account and API endpoint as
+        metal_conn, sharing its connections, to be used from another thread.
+        """
+        conn = self.metal_conn
+        manager = conn.__class__(auth_token=conn.auth_token, consumer_token=conn.consumer_token,
+                                 session=conn.session, scheduler=conn.scheduler, metrics=conn.metrics,
+                                 max_retries=conn.max_retries)
+        manager.end_point = conn.end_point
+        return manager
+
+    def get_device(self, device_id, manager=None):
+        """
+        Fetch a single device of the project by its ID, with manager or
+        metal_conn, or return None when there is no such device in the project.
+        """
+        import packet
+        from packet.baseapi import ResponseError
+
+        manager = manager or self.metal_conn
+        try:
+            data = manager.call_api('devices/%s' % device_id)
+        except ResponseError as e:
+            if e.response.status_code == 404:
+                return None
+            raise
+        project_href = (data.get('project') or {}).get('href', '')
+        if project_href.rstrip('/').split('/')[-1] != self.params.get('project_id'):
+            return None
+        return packet.Device(data, manager)
 
     @property
     def params(self):
         return self._module.params
 
     def exit_json(self, *args, **kwargs):
+        if self.metrics is not None:
+            kwargs['metal_metrics'] = self.metrics.as_dict()
         return self._module.exit_json(*args, **kwargs)
 
     def fail_json(self, *args, **kwargs):
+        if self.metrics is not None:
+            kwargs['metal_metrics'] = self.metrics.as_dict()
         return self._module.fail_json(*args, **kwargs)
 
     def debug(self, *args, **kwargs):
@@ -108,6 +679,242 @@ class AnsibleMetalModule(object):
         return self._module.md5(*args, **kwargs)
 
 
+def paginate(manager, path, key, params=None):
+    """
+    Yield the raw items listed under key on every page of a paginated API
+    listing, requesting the next page only once the previous one is consumed.
+    """
+    params = dict(params or {})
+    page = params.pop('page', 1)
+    while True:
+        params['page'] = page
+        data = manager.call_api(path, params=params)
+        for item in data[key]:
+            yield item
+        if not manager.meta or manager.meta.get('next') is None:
+            break
+        page += 1
+
+
+def poll_delays(initial=1.0, maximum=15.0, factor=1.5):
+    """
+    Yield the delays to wait between polls of something that gets ready
+    eventually: growing exponentially from initial up to maximum, each
+    jittered down by up to a half so that concurrent pollers spread out.
+    """
+    delay = initial
+    while True:
+        yield delay / 2 + random.uniform(0, delay / 2)
+        delay = min(maximum, delay * factor)
+
+
+def map_concurrently(func, items, max_workers=1):
+    """
+    Call func on every item from up to max_workers threads, and return a list
+    of (result, exception) pairs in the order of items.  Failures do not
+    stop the other calls.
+    """
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [call(item) for item in items]
+
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class WaitTimeout(Exception):
+    """The devices still not ready when the wait for them timed out"""
+
+    def __init__(self, devices):
+        super(WaitTimeout, self).__init__('timed out waiting for %s' % ', '.join(d.hostname for d in devices))
+        self.devices = devices
+
+
+def has_public_ip(device, ip_v):
+    return any(a['public'] and a['address_family'] == ip_v and a['address']
+               for a in device.ip_addresses)
+
+
+def device_wait_token(active_device_ids=(), public_ip_device_ids=(), public_ipv=None):
+    """
+    Describe what to wait for before devices are ready: the IDs of the
+    devices to be active and of the devices to have a public IP address of
+    the public_ipv family.  The description is a plain dict, so that it can
+    be returned by a module and passed to another one to wait later.
+    """
+    return {
+        'active_device_ids': list(active_device_ids),
+        'public_ip_device_ids': list(public_ip_device_ids) if public_ipv else [],
+        'public_ipv': public_ipv,
+    }
+
+
+def wait_for_batches(manager, batch_ids, deadline):
+    """
+    Poll the device batches with the given IDs until the API processed all
+    of them, or until deadline (a time.time() value).  Return the processed
+    batches, including their devices, and the IDs of the batches still
+    pending at the deadline.
+    """
+    pending = list(batch_ids)
+    processed = []
+    delays = poll_delays()
+    while True:
+        for batch_id in list(pending):
+            data = manager.call_api('batches/%s' % batch_id, params={'include': 'devices'})
+            if data.get('state') in BATCH_PROCESSED_STATES:
+                processed.append(data)
+                pending.remove(batch_id)
+        remaining = deadline - time.time()
+        if not pending or remaining <= 0:
+            return processed, pending
+        time.sleep(min(next(delays), remaining))
+
+
+def device_readiness(wait_tokens):
+    """
+    Merge wait tokens (see device_wait_token) into the list of the IDs of
+    the devices to wait for and a function telling whether a device is ready.
+    """
+    device_ids = OrderedDict()
+    active_ids = set()
+    public_ip_families = {}
+    for token in wait_tokens:
+        for device_id in token.get('active_device_ids') or []:
+            device_ids[device_id] = None
+            active_ids.add(device_id)
+        for device_id in token.get('public_ip_device_ids') or []:
+            device_ids[device_id] = None
+            public_ip_families.setdefault(device_id, set()).add(token['public_ipv'])
+
+    def is_ready(device):
+        if device.id in active_ids and device.state != 'active':
+            return False
+        return all(has_public_ip(device, ip_v) for ip_v in public_ip_families.get(device.id, ()))
+
+    return list(device_ids), is_ready
+
+
+def wait_for_devices(refresh, watched_devices, is_ready, timeout):
+    """
+    Wait up to timeout seconds for is_ready to be true for all the watched
+    devices.  After each of the delays of poll_delays, the devices not ready
+    yet are passed to refresh, which returns them fetched again.  Return the
+    devices, refreshed when they were not ready at first, in the order of
+    watched_devices, or raise a WaitTimeout with the devices still not ready.
+    """
+    deadline = time.time() + timeout
+    pending = OrderedDict((d.id, d) for d in watched_devices)
+    ready = {}
+    delays = poll_delays()
+    devices = watched_devices
+    while True:
+        for d in devices:
+            if is_ready(d):
+                pending.pop(d.id, None)
+                ready[d.id] = d
+            else:
+                pending[d.id] = d
+        if not pending:
+            return [ready[d.id] for d in watched_devices]
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise WaitTimeout(list(pending.values()))
+        time.sleep(min(next(delays), remaining))
+        devices = refresh(list(pending.values()))
+
+
+class DeviceEventsRefresh(object):
+    """
+    A refresh function for wait_for_devices fetching again only the devices
+    mentioned by the events of their project since the previous call.
+
+    The events are read from a cursor, the newest event seen per project, so
+    every call reads one page of events in the common case.  In case the
+    events miss a change, all the devices are fetched again at least every
+    full_refresh_interval seconds, and whenever the cursor is lost.
+
+    :param fetch: a function fetching the devices of a list of devices again
+    :param manager: the manager to read the events with
+    """
+
+    def __init__(self, fetch, manager, full_refresh_interval=FULL_REFRESH_INTERVAL):
+        self.fetch = fetch
+        self.manager = manager
+        self.full_refresh_interval = full_refresh_interval
+        self._cursors = {}
+        self._last_full_refresh = None
+
+    def __call__(self, devices):
+        project_ids = set(device_project_id(d) for d in devices)
+        project_ids.discard(None)
+
+        if self._last_full_refresh is None or time.time() - self._last_full_refresh >= self.full_refresh_interval:
+            return self._full_refresh(devices, project_ids)
+
+        changed_ids = set()
+        for project_id in project_ids:
+            device_ids = self._read_events(project_id)
+            if device_ids is None:
+                return self._full_refresh(devices, project_ids)
+            changed_ids.update(device_ids)
+
+        stale = [d for d in devices if d.id in changed_ids or device_project_id(d) is None]
+        if not stale:
+            return devices
+        refreshed = dict((d.id, d) for d in self.fetch(stale))
+        return [refreshed.get(d.id, d) for d in devices]
+
+    def _full_refresh(self, devices, project_ids):
+        # move the cursors first, so that no event after the fetch is missed
+        for project_id in project_ids:
+            self._read_events(project_id)
+        self._last_full_refresh = time.time()
+        return self.fetch(devices)
+
+    def _read_events(self, project_id):
+        """
+        Move the cursor of the project to its newest event, and return the
+        IDs of the devices related to the events since the cursor, or None
+        when the cursor could not be found in the MAX_EVENTS_READ newest
+        events.
+        """
+        first_read = project_id not in self._cursors
+        cursor = self._cursors.setdefault(project_id, None)
+        device_ids = set()
+        events = paginate(self.manager, 'projects/%s/events' % project_id, 'events',
+                          params={'per_page': EVENTS_PER_PAGE})
+        for count, event in enumerate(events):
+            if count == 0:
+                self._cursors[project_id] = event['id']
+                if first_read:
+                    break
+            if event['id'] == cursor:
+                break
+            if count >= MAX_EVENTS_READ:
+                return None
+            for relationship in event.get('relationships') or []:
+                match = DEVICE_HREF_RE.search(relationship.get('href') or '')
+                if match:
+                    device_ids.add(match.group(1))
+        return device_ids
+
+
+def device_project_id(device):
+    match = PROJECT_HREF_RE.search((device.project or {}).get('href') or '')
+    return match.group(1) if match else None
+
+
 def metal_argument_spec():
     return dict(
         api_token=dict(
@@ -117,6 +924,31 @@ def metal_argument_spec():
             aliases=['auth_token'],
             required=True
         ),
+        api_rate_limit=dict(
+            type='float',
+            fallback=(env_fallback, ['METAL_API_RATE_LIMIT']),
+        ),
+        api_retries=dict(
+            type='int',
+            default=MAX_REQUEST_RETRIES,
+            fallback=(env_fallback, ['METAL_API_RETRIES']),
+        ),
+        api_metrics=dict(
+            type='bool',
+            default=False,
+            fallback=(env_fallback, ['METAL_API_METRICS']),
+        ),
+        api_metrics_file=dict(
+            type='path',
+            fallback=(env_fallback, ['METAL_API_METRICS_FILE']),
+        ),
+    )
+
+
+def metal_catalog_cache_argument_spec():
+    return dict(
+        catalog_cache_ttl=dict(type='int', default=DEFAULT_CATALOG_CACHE_TTL),
+        catalog_cache_dir=dict(type='path', default=DEFAULT_CATALOG_CACHE_DIR),
     )
 
 
@@ -0,0 +1,208 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+# The API client of the modules and the inventory, needing packet-python and
+# requests. Modules only import it when they create their first API client,
+# with import_metal_sdk() of the metal module_utils.
+
+import json
+import time
+
+import packet
+import requests
+from packet.baseapi import Error as MetalError, JSONReadError, ResponseError
+
+from ansible_collections.equinix.metal.plugins.module_utils.metal import (
+    DEFAULT_POOL_SIZE,
+    IDEMPOTENT_METHODS,
+    MAX_REQUEST_RETRIES,
+    RETRY_STATUS_CODES,
+    UNPROCESSED_STATUS_CODES,
+    RequestScheduler,
+    body_size,
+    parse_retry_after,
+)
+
+
+def metal_session(pool_size=DEFAULT_POOL_SIZE):
+    """
+    Create a requests session keeping up to pool_size connections to the
+    Equinix Metal API alive, to be shared by MetalManager instances.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    return session
+
+
+def is_retryable(type, status_code=None, error=None):
+    """
+    Whether an API request of the given method, answered with status_code or
+    failed with error (a MetalError), may be sent again.  Any request
+    throttled (429) or refused as unavailable (503) was not processed by the
+    API, nor was one whose connection timed out, so it is retried even when
+    it creates something.  A 502 or 504 may come from a gateway that gave up
+    while the API was still processing the request, so like other
+    communication errors it only retries GET and DELETE requests.
+    """
+    idempotent = type in IDEMPOTENT_METHODS
+    if error is not None:
+        return idempotent or isinstance(getattr(error, 'cause', None), requests.exceptions.ConnectTimeout)
+    return status_code in (RETRY_STATUS_CODES if idempotent else UNPROCESSED_STATUS_CODES)
+
+
+class MetalManager(packet.Manager):
+    """A packet.Manager sending its API calls through a requests session
+
+    packet-python issues every call through the module level requests
+    functions, which opens a new connection (and does a new TLS handshake)
+    per call.  MetalManager reuses the keep-alive connections of its
+    session instead.  Its ``end_point`` may also include the URL scheme,
+    e.g. to talk to a local test server.
+
+    The requests of all the managers using the same API token are paced
+    by a RequestScheduler, and retried up to max_retries times when
+    is_retryable tells the API did not process them.  This is the only
+    place API requests are retried.
+
+    Every request sent is recorded by metrics, if given (see ApiMetrics).
+
+    The manager keeps per call state (``meta``), so it must not be shared
+    between threads; use one manager per thread sharing a single session.
+    """
+
+    def __init__(self, auth_token, consumer_token=None, session=None, scheduler=None, metrics=None,
+                 max_retries=MAX_REQUEST_RETRIES):
+        super(MetalManager, self).__init__(auth_token, consumer_token)
+        if session is None:
+            session = metal_session()
+        if scheduler is None:
+            scheduler = RequestScheduler.for_token(auth_token)
+        self.session = session
+        self.scheduler = scheduler
+        self.metrics = metrics
+        self.max_retries = max_retries
+
+    def call_api(self, method, type="GET", params=None):  # noqa
+        return self._read_response(self._send(method, type, params))
+
+    def get_if_modified(self, method, params=None, etag=None, last_modified=None):
+        """
+        GET method, unless it did not change since the response with the
+        given ETag or Last-Modified header.  Return the data (None when it
+        did not change) and the ETag and Last-Modified headers to send
+        next time.
+        """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        resp = self._send(method, "GET", params, headers)
+        if resp.status_code == 304:
+            return None, etag, last_modified
+        data = self._read_response(resp)
+        return data, resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+
+    def _send(self, method, type, params, extra_headers=None):
+        attempt = 0
+        while True:
+            self.scheduler.acquire()
+            try:
+                resp = self._timed_request(method, type, params, extra_headers, attempt)
+            except MetalError as e:
+                if attempt >= self.max_retries or not is_retryable(type, error=e):
+                    raise
+                time.sleep(2 ** attempt)
+                attempt += 1
+                continue
+
+            self.scheduler.observe(resp)
+            delay = parse_retry_after(resp.headers.get('Retry-After'))
+            if resp.status_code == 429:
+                self.scheduler.throttled(2 ** attempt if delay is None else delay)
+            elif is_retryable(type, status_code=resp.status_code):
+                time.sleep(2 ** attempt if delay is None else delay)
+            else:
+                self.scheduler.succeeded()
+                return resp
+            if attempt >= self.max_retries:
+                return resp
+            attempt += 1
+
+    def _timed_request(self, method, type, params, extra_headers, attempt):
+        if self.metrics is None:
+            return self._request(method, type, params, extra_headers)
+        started = time.time()
+        try:
+            resp = self._request(method, type, params, extra_headers)
+        except MetalError:
+            self.metrics.record(type, method, None, time.time() - started, attempt=attempt)
+            raise
+        request = getattr(resp, 'request', None)
+        self.metrics.record(type, method, resp.status_code, time.time() - started,
+                            bytes_sent=body_size(getattr(request, 'body', None)),
+                            bytes_received=body_size(resp.content), attempt=attempt)
+        return resp
+
+    def _request(self, method, type, params, extra_headers=None):
+        if params is None:
+            params = {}
+
+        if "://" in self.end_point:
+            url = self.end_point + "/" + method
+        else:
+            url = "https://" + self.end_point + "/" + method
+
+        headers = {
+            "X-Auth-Token": self.auth_token,
+            "X-Consumer-Token": self.consumer_token,
+            "Content-Type": "application/json",
+            "User-Agent": self.user_agent,
+        }
+        if extra_headers:
+            headers.update(extra_headers)
+
+        try:
+            if type == "GET":
+                url = url + "%s" % self._parse_params(params)
+                return self.session.get(url, headers=headers)
+            elif type == "POST":
+                return self.session.post(
+                    url,
+                    headers=headers,
+                    data=json.dumps(params, default=lambda o: o.__dict__, sort_keys=True, indent=4),
+                )
+            elif type == "DELETE":
+                return self.session.delete(url, headers=headers)
+            elif type == "PATCH":
+                return self.session.patch(url, headers=headers, data=json.dumps(params))
+            else:
+                raise MetalError("method type not recognized as one of GET, POST, DELETE or PATCH: %s" % type)
+        except requests.exceptions.RequestException as e:
+            raise MetalError("Communications error: %s" % str(e), e)
+
+    def _read_response(self, resp):
+        if not resp.content:
+            data = None
+        elif resp.headers.get("content-type", "").startswith("application/json"):
+            try:
+                data = resp.json()
+            except ValueError as e:
+                raise JSONReadError("Read failed: %s" % e, e)
+        else:
+            data = resp.content
+
+        if not resp.ok:
+            raise ResponseError(resp, data)
+
+        self.meta = None
+        try:
+            if data and data["meta"]:
+                self.meta = data["meta"]
+        except (KeyError, IndexError, TypeError):
+            pass
+
+        return data
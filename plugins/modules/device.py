@@ -29,6 +29,7 @@ notes:
 extends_documentation_fragment:
      - equinix.metal.metal
      - equinix.metal.metal_project
+     - equinix.metal.metal_catalog_cache
 options:
     count:
         description:
@@ -55,6 +56,15 @@ options:
         description:
             - Facility slug for device creation. See the Equinix Metal API for current list - U(https://metal.equinix.com/developers/api/facilities/).
         type: str
+    facilities:
+        description:
+            - Candidate facility slugs for device creation, in order of preference, instead of a single I(facility).
+            - The devices are created in the first facilities with I(plan) in stock, according to the capacity data of the API,
+              and no more devices are created in a facility than the servers it has available, when the API tells.
+            - The module fails before creating any device if the facilities do not have enough servers available.
+            - The capacity data is cached as described for I(catalog_cache_ttl), for a minute at most.
+        type: list
+        elements: str
     features:
         description:
             - Dict with "features" for device creation. See Equinix Metal API docs for details.
@@ -103,9 +113,17 @@ options:
     wait_timeout:
         description:
             - How long (seconds) to wait either for automatic IP address assignment, or for the device to reach the C(active) I(state).
-            - If I(wait_for_public_IPv) is set and I(state) is C(active), the module will wait for both events consequently, applying the timeout twice.
+            - If I(wait_for_public_IPv) is set and I(state) is C(active), the module waits for both at the same time, within a single timeout.
+            - With I(batch), the timeout includes the time the API takes to process the batch.
         default: 900
         type: int
+    wait:
+        description:
+            - Whether to wait for the devices to be active with I(state=active), and for their public IP address with I(wait_for_public_IPv).
+            - If set to C(false), the module returns right after the devices were created or changed, with a I(wait_token) to wait for them
+              later with M(equinix.metal.device_wait), e.g. after starting the provisioning of other devices.
+        default: true
+        type: bool
     ipxe_script_url:
         description:
             - URL of custom iPXE script for provisioning.
@@ -117,6 +135,43 @@ options:
             - Normally, the PXE process happens only on the first boot. Set this arg to have your device continuously boot to iPXE.
         default: false
         type: bool
+    max_workers:
+        description:
+            - How many devices to create, delete, power on or off, or reboot at the same time, and how many devices or
+              hostnames to look up at the same time.
+        default: 10
+        type: int
+    batch:
+        description:
+            - Whether to create several devices with a single batch request, instead of a request per device.
+            - The module then waits for the API to process the batch, within I(wait_timeout), and creates the devices the batch
+              did not create one by one. It does so with I(wait=false) too, since the devices of a batch are only known once the
+              API processed it.
+            - The devices of a batch the API did not process within I(wait_timeout) are reported as failed, and the IDs of the batch
+              in I(pending_batch_ids). The batch may still create them, even with I(on_partial_failure=rollback).
+            - Batches are sent with the same parameters as the requests creating a single device.
+            - When the API rejects the batch request (HTTP 4xx), the devices are created one by one. Other errors fail the module,
+              since the batch may have been created.
+        default: true
+        type: bool
+    preflight_checks:
+        description:
+            - Whether to check, before creating devices, that I(plan) is available in I(facility) and that I(operating_system) is
+              provisionable on I(plan), according to the plan and operating system catalogs.
+            - I(plan) and I(operating_system) may be given by slug or by ID. A plan or an operating system the public catalogs do
+              not list, like the plan of a hardware reservation, is not checked, with a warning.
+            - The catalogs are cached as described for I(catalog_cache_ttl).
+        default: true
+        type: bool
+    on_partial_failure:
+        description:
+            - What to do with the devices created when some of the other devices could not be created.
+            - With C(keep), they are kept and reported in I(devices).
+            - With C(rollback), they are deleted.
+            - The module fails in both cases, reporting the hostnames in I(created_hostnames) and I(failed_hostnames).
+        choices: [keep, rollback]
+        default: keep
+        type: str
 '''
 
 EXAMPLES = '''
@@ -203,6 +258,26 @@ EXAMPLES = '''
     with_items: "{{ newhosts.devices }}"
 
 
+- name: Start the provisioning of devices in two facilities, then wait for all of them
+  hosts: localhost
+  tasks:
+  - equinix.metal.device:
+      project_id: 89b497ee-5afc-420a-8fb5-56984898f4df
+      hostnames: "{{ item }}-%02d"
+      count: 10
+      operating_system: ubuntu_16_04
+      plan: baremetal_0
+      facility: "{{ item }}"
+      state: active
+      wait: false
+    loop: [sjc1, ewr1]
+    register: provisioning
+
+  - equinix.metal.device_wait:
+      wait_tokens: "{{ provisioning.results | map(attribute='wait_token') | list }}"
+    register: provisioned
+
+
 # Other states of devices
 
 - name: Remove 3 devices by uuid
@@ -232,22 +307,63 @@ devices:
                "tags": [], "locked": false, "state": "provisioning",
                "public_ipv6": ""2604:1380:2:5200::3"}]'
     returned: success
+
+created_hostnames:
+    description: Hostnames of the devices created before the creation of other devices failed
+    type: list
+    sample: '["server-01", "server-03"]'
+    returned: when the creation of some devices failed
+
+failed_hostnames:
+    description: Hostnames of the devices that could not be created, deleted, powered on or off, or rebooted
+    type: list
+    sample: '["server-02"]'
+    returned: when the action failed on some devices
+
+wait_token:
+    description:
+        - What to wait for before the devices are ready, to pass to M(equinix.metal.device_wait).
+        - The IDs of the devices to wait to be active, and of the devices to wait to have a public IP address of the I(public_ipv) family.
+    type: dict
+    sample: '{"active_device_ids": ["2a5122b9-c323-4d5c-b53c-9ad3f54273e7"],
+              "public_ip_device_ids": ["2a5122b9-c323-4d5c-b53c-9ad3f54273e7"], "public_ipv": 4}'
+    returned: when I(wait=false)
+
+pending_batch_ids:
+    description: IDs of the device batches the API had not processed within I(wait_timeout), which may still create devices
+    type: list
+    sample: '["6d2cc0d0-ad6a-4a44-8e0f-3d3e5d2b4c5e"]'
+    returned: when the creation of some devices failed because their batch was not processed in time
+
+rolled_back_hostnames:
+    description: Hostnames of the created devices deleted again, because the creation of other devices failed
+    type: list
+    sample: '["server-01", "server-03"]'
+    returned: when the creation of some devices failed and I(on_partial_failure=rollback)
 '''  # NOQA
 
 
 import re
 import time
 import traceback
+from collections import OrderedDict
 
 from ansible.module_utils._text import to_native
 
-HAS_METAL_SDK = True
-try:
-    import packet
-except ImportError:
-    HAS_METAL_SDK = False
-
-from ansible_collections.equinix.metal.plugins.module_utils.metal import AnsibleMetalModule, is_valid_uuid, is_valid_hostname, serialize_device
+from ansible_collections.equinix.metal.plugins.module_utils.metal import (
+    HAS_METAL_SDK,
+    AnsibleMetalModule,
+    DeviceEventsRefresh,
+    WaitTimeout,
+    device_readiness,
+    device_wait_token,
+    is_valid_hostname,
+    is_valid_uuid,
+    map_concurrently,
+    serialize_device,
+    wait_for_batches,
+    wait_for_devices,
+)
 
 METAL_DEVICE_STATES = (
     'queued',
@@ -263,6 +379,25 @@ METAL_DEVICE_STATES = (
 
 ALLOWED_STATES = ['absent', 'active', 'inactive', 'rebooted', 'present']
 
+# from the best to the worst, "unavailable" facilities are not used
+CAPACITY_LEVELS = ('normal', 'limited')
+
+# Up to this many device IDs or hostnames are looked up one by one, more are
+# picked from a listing of the whole project
+MAX_DEVICE_LOOKUPS = 20
+
+
+class BatchRejected(Exception):
+    """The API did not accept a batch request"""
+
+
+class DeviceActionError(Exception):
+    """An error leaving the devices partially processed, carrying the result to report"""
+
+    def __init__(self, msg, result):
+        super(DeviceActionError, self).__init__(msg)
+        self.result = result
+
 
 def get_hostname_list(module):
     hostnames = module.params.get('hostnames')
@@ -300,80 +435,345 @@ def get_device_id_list(module):
     return device_ids
 
 
-def create_single_device(module, hostname):
-
+def validate_creation_params(module):
     for param in ('hostnames', 'operating_system', 'plan'):
         if not module.params.get(param):
             raise Exception("%s parameter is required for new device."
                             % param)
-    project_id = module.params.get('project_id')
-    plan = module.params.get('plan')
-    tags = module.params.get('tags')
-    user_data = module.params.get('user_data')
-    facility = module.params.get('facility')
-    operating_system = module.params.get('operating_system')
-    locked = module.params.get('locked')
-    ipxe_script_url = module.params.get('ipxe_script_url')
-    always_pxe = module.params.get('always_pxe')
-    if operating_system != 'custom_ipxe':
+    if module.params.get('operating_system') != 'custom_ipxe':
         for param in ('ipxe_script_url', 'always_pxe'):
             if module.params.get(param):
                 raise Exception('%s parameter is not valid for non custom_ipxe operating_system.' % param)
 
-    device = module.metal_conn.create_device(
-        project_id=project_id,
-        hostname=hostname,
-        tags=tags,
-        plan=plan,
-        facility=facility,
-        operating_system=operating_system,
-        userdata=user_data,
-        locked=locked,
-        ipxe_script_url=ipxe_script_url,
-        always_pxe=always_pxe)
-    return device
+    if module.params.get('preflight_checks'):
+        try:
+            index = module.get_catalog_index()
+        except Exception as e:
+            module.warn('Could not check the plan, operating system and facility against the catalogs: %s'
+                        % to_native(e))
+            return
+        plan, operating_system = module.params.get('plan'), module.params.get('operating_system')
+        unknown = index.unknown(plan, operating_system)
+        if unknown:
+            module.warn('Could not check %s, not listed by the public catalogs' % ' and '.join(unknown))
+        # the facilities option is checked against the capacity data instead
+        problems = index.problems(plan, operating_system, module.params.get('facility'))
+        if problems:
+            raise Exception('Cannot create devices: %s.' % '; '.join(problems))
+
+
+def get_placement(module, hostnames):
+    """
+    Return an OrderedDict of the facility to create each device in: the
+    facility option, or with facilities, the candidate facilities with the
+    plan in stock according to the capacity data, in order of preference.
+    A facility gets at most as many devices as the servers it has available,
+    when the capacity data tells.
+    """
+    facilities = module.params.get('facilities')
+    if not facilities:
+        return OrderedDict((hostname, module.params.get('facility')) for hostname in hostnames)
 
-
-def refresh_device_list(module, devices):
-    device_ids = [d.id for d in devices]
-    new_device_list = module.get_devices()
-    return [d for d in new_device_list if d.id in device_ids]
+    plan = module.params.get('plan')
+    capacity = module.get_capacity()
+    candidates = []
+    for preference, facility in enumerate(facilities):
+        stock = (capacity.get(facility) or {}).get(plan) or {}
+        level = stock.get('level')
+        if level in CAPACITY_LEVELS:
+            candidates.append((CAPACITY_LEVELS.index(level), preference, facility, stock.get('available_servers')))
+
+    placement = OrderedDict()
+    remaining = list(hostnames)
+    for _, _, facility, available_servers in sorted(candidates):
+        count = len(remaining) if available_servers is None else int(available_servers)
+        for hostname in remaining[:count]:
+            placement[hostname] = facility
+        remaining = remaining[count:]
+    if remaining:
+        raise Exception("Not enough capacity for %d more %s devices in facilities %s"
+                        % (len(remaining), plan, ', '.join(facilities)))
+    return OrderedDict((hostname, placement[hostname]) for hostname in hostnames)
+
+
+def device_creation_params(module, facility):
+    """
+    Return the parameters of packet.Manager.create_device for the devices to
+    create in facility, but their hostname.  Batch requests send the same.
+    """
+    return {
+        'project_id': module.params.get('project_id'),
+        'plan': module.params.get('plan'),
+        'facility': facility,
+        'operating_system': module.params.get('operating_system'),
+        'billing_cycle': 'hourly',
+        'features': module.params.get('features') or {},
+        'locked': module.params.get('locked'),
+        'tags': module.params.get('tags'),
+        'userdata': module.params.get('user_data'),
+        'ipxe_script_url': module.params.get('ipxe_script_url'),
+        'always_pxe': module.params.get('always_pxe'),
+    }
 
 
-def wait_for_devices_active(module, watched_devices):
-    wait_timeout = module.params.get('wait_timeout')
-    wait_timeout = time.time() + wait_timeout
-    refreshed = watched_devices
-    while wait_timeout > time.time():
-        refreshed = refresh_device_list(module, watched_devices)
-        if all(d.state == 'active' for d in refreshed):
-            return refreshed
-        time.sleep(5)
-    raise Exception("Waiting for state \"active\" timed out for devices: %s"
-                    % [d.hostname for d in refreshed if d.state != "active"])
+def create_single_device(module, hostname, manager=None, facility=None):
+    if manager is None:
+        manager = module.metal_conn
+    if facility is None:
+        facility = module.params.get('facility')
+    return manager.create_device(hostname=hostname, **device_creation_params(module, facility))
+
+
+def create_devices_in_batch(module, placement, deadline):
+    """
+    Create the devices of placement with a single batch request, holding a
+    batch per facility, and wait for the API to process the batches until
+    deadline, even when wait is false, since their devices are not known
+    before.  Return the created devices, the hostnames of the devices the
+    batches did not create, an OrderedDict of the error message per hostname
+    of the batches not processed before deadline, and the IDs of those
+    batches.  Raise a BatchRejected error when the API rejected the batch
+    request.
+    """
+    # not imported with the module, see import_metal_sdk
+    import packet
+    from packet.baseapi import ResponseError
+
+    batches = []
+    for facility in OrderedDict.fromkeys(placement.values()):
+        hostnames = [hn for hn, f in placement.items() if f == facility]
+        batch = device_creation_params(module, facility)
+        project_id = batch.pop('project_id')
+        if not batch['ipxe_script_url']:
+            # like packet.Manager.create_device
+            del batch['ipxe_script_url'], batch['always_pxe']
+        batch.update(hostnames=hostnames, quantity=len(hostnames))
+        batches.append(batch)
 
+    try:
+        data = module.metal_conn.call_api('projects/%s/devices/batch' % project_id, type='POST',
+                                          params={'batches': batches})
+    except ResponseError as e:
+        # after a gateway error the batch may have been created anyway, so
+        # only a rejected request may be followed by per device requests
+        if 400 <= e.response.status_code < 500:
+            raise BatchRejected(to_native(e))
+        raise
+    batch_ids = [b['id'] for b in data['batches']]
+    processed, pending = wait_for_batches(module.metal_conn, batch_ids, deadline)
 
-def wait_for_public_IPv(module, created_devices):
+    created_devices = []
+    error_messages = []
+    for data in processed:
+        for device in data.get('devices') or []:
+            if 'operating_system' in device:
+                created_devices.append(packet.Device(device, module.metal_conn))
+            else:
+                created_devices.append(module.metal_conn.get_device(device['href'].rstrip('/').split('/')[-1]))
+        error_messages.extend(data.get('error_messages') or [])
+
+    unprocessed_hostnames = OrderedDict()
+    for batch, batch_id in zip(batches, batch_ids):
+        if batch_id in pending:
+            for hostname in batch['hostnames']:
+                unprocessed_hostnames[hostname] = 'batch %s not processed within wait_timeout' % batch_id
+
+    created_hostnames = set(d.hostname for d in created_devices)
+    missing_hostnames = [hn for hn in placement if hn not in created_hostnames and hn not in unprocessed_hostnames]
+    if missing_hostnames:
+        module.warn('The batch did not create %s (%s), creating them one by one'
+                    % (', '.join(missing_hostnames), '; '.join(error_messages) or 'no error given'))
+    return created_devices, missing_hostnames, unprocessed_hostnames, pending
+
+
+def create_devices(module, hostnames, deadline):
+    """
+    Create a device per hostname, in the facilities given by get_placement:
+    with a batch request when there are several of them and batch is set,
+    and for the devices not created by the batch, from up to max_workers
+    threads.  Return the created devices, an OrderedDict of the error
+    message per hostname that could not be created, and the IDs of the
+    batches the API had not processed by deadline, which may still create
+    devices.
+    """
+    placement = get_placement(module, hostnames)
+    order = dict((hostname, i) for i, hostname in enumerate(hostnames))
+    created_devices = []
+    failed_hostnames = OrderedDict()
+    pending_batch_ids = []
+
+    if module.params.get('batch') and len(hostnames) > 1:
+        try:
+            created_devices, hostnames, failed_hostnames, pending_batch_ids = \
+                create_devices_in_batch(module, placement, deadline)
+        except BatchRejected as e:
+            module.warn('Could not create the devices in a batch, creating them one by one: %s' % e)
+
+    def create(hostname):
+        return create_single_device(module, hostname, module.new_manager(), placement[hostname])
+
+    results = map_concurrently(create, hostnames, module.params.get('max_workers'))
+    for hostname, (device, error) in zip(hostnames, results):
+        if error is None:
+            created_devices.append(device)
+        else:
+            failed_hostnames[hostname] = to_native(error)
+    created_devices.sort(key=lambda d: order.get(d.hostname, len(order)))
+    return created_devices, failed_hostnames, pending_batch_ids
+
+
+def fail_partial_creation(module, changed, created_devices, failed_hostnames, pending_batch_ids=()):
+    """
+    Raise a DeviceActionError reporting which devices were created and which
+    were not, after deleting the created ones if on_partial_failure asks so.
+    The IDs of the batches still pending are reported too, since they may
+    create devices after the module exits, which are not deleted.
+    """
+    msg = 'could not create %s' % ', '.join('%s (%s)' % f for f in failed_hostnames.items())
+    kept_devices = created_devices
+    result = {
+        'changed': changed or bool(created_devices) or bool(pending_batch_ids),
+        'created_hostnames': [d.hostname for d in created_devices],
+        'failed_hostnames': list(failed_hostnames),
+    }
+    if pending_batch_ids:
+        result['pending_batch_ids'] = list(pending_batch_ids)
+
+    if module.params.get('on_partial_failure') == 'rollback' and created_devices:
+        def delete(device):
+            return module.new_manager().call_api('devices/%s' % device.id, type='DELETE')
+
+        results = map_concurrently(delete, created_devices, module.params.get('max_workers'))
+        kept_devices = [d for d, (_, error) in zip(created_devices, results) if error is not None]
+        result['rolled_back_hostnames'] = [d.hostname for d, (_, error) in zip(created_devices, results) if error is None]
+        if kept_devices:
+            msg += ', and could not roll back %s' % ', '.join(
+                '%s (%s)' % (d.hostname, to_native(error)) for d, (_, error) in zip(created_devices, results) if error is not None)
+
+    if pending_batch_ids:
+        msg += ', and batches %s, still being processed, may create devices later' % ', '.join(pending_batch_ids)
+        if module.params.get('on_partial_failure') == 'rollback':
+            msg += ', which will not be rolled back'
+
+    result['devices'] = [serialize_device(d) for d in kept_devices]
+    raise DeviceActionError(msg, result)
+
+
+def run_device_operations(module, operations, devices):
+    """
+    Apply the (device, packet.Device method) operations from up to
+    max_workers threads.  Raise a DeviceActionError naming the devices
+    whose operation failed.
+    """
+    def run(operation):
+        device, api_operation = operation
+        # the device's manager is not thread-safe, give it one of its own
+        device.manager = module.new_manager()
+        return api_operation(device)
+
+    results = map_concurrently(run, operations, module.params.get('max_workers'))
+    failed = [(d, error) for (d, _), (_, error) in zip(operations, results) if error is not None]
+    if failed:
+        raise DeviceActionError(
+            'could not %s' % ', '.join('%s %s (%s)' % (op.__name__, d.hostname, to_native(error))
+                                       for (d, op), (_, error) in zip(operations, results) if error is not None),
+            {
+                'changed': len(failed) < len(operations),
+                'devices': [serialize_device(d) for d in devices],
+                'failed_hostnames': [d.hostname for d, _ in failed],
+            })
+
+
+def lookup_devices(module, lookup, keys):
+    """
+    Call lookup(manager, key) for every key from up to max_workers threads,
+    each with a manager of its own, and return the results in the order of
+    keys.  The first failed lookup is raised once all of them are done.
+    """
+    results = map_concurrently(lambda key: lookup(module.new_manager(), key), keys,
+                               module.params.get('max_workers'))
+    for _, error in results:
+        if error is not None:
+            raise error
+    return [result for result, _ in results]
+
+
+def find_devices_by_id(module, device_ids):
+    """
+    Return the devices of the project with the given IDs.  A few devices are
+    fetched concurrently one by one, more are picked from the project device
+    listing, which is not read further once all of them are found.
+    """
+    missing = set(device_ids)
+    found = []
+    if not missing:
+        return found
+    if len(missing) <= MAX_DEVICE_LOOKUPS:
+        devices = lookup_devices(module, lambda manager, device_id: module.get_device(device_id, manager=manager),
+                                 list(OrderedDict.fromkeys(device_ids)))
+        return [d for d in devices if d is not None]
+    for d in module.iter_devices():
+        if d.id in missing:
+            found.append(d)
+            missing.discard(d.id)
+            if not missing:
+                break
+    return found
+
+
+def find_devices_by_hostname(module, hostnames):
+    """
+    Return all the devices of the project with one of the given hostnames.
+    A few hostnames are looked up concurrently with the API search filter,
+    which also matches them partially and in other attributes, more are
+    picked from a full listing of the project.
+    """
+    wanted = set(hostnames)
+    if not wanted:
+        return []
+    if len(wanted) > MAX_DEVICE_LOOKUPS:
+        return [d for d in module.iter_devices() if d.hostname in wanted]
+    matches = lookup_devices(module, lambda manager, hostname: list(module.iter_devices(manager=manager, search=hostname)),
+                             list(OrderedDict.fromkeys(hostnames)))
+    found = OrderedDict()
+    for devices in matches:
+        for d in devices:
+            if d.hostname in wanted:
+                found[d.id] = d
+    return list(found.values())
 
-    def has_public_ip(addr_list, ip_v):
-        return any([a['public'] and a['address_family'] == ip_v
-                    and a['address'] for a in addr_list])
 
-    def all_have_public_ip(ds, ip_v):
-        return all([has_public_ip(d.ip_addresses, ip_v) for d in ds])
+def refresh_device_list(module, devices):
+    return find_devices_by_id(module, [d.id for d in devices])
 
-    address_family = module.params.get('wait_for_public_IPv')
 
-    wait_timeout = module.params.get('wait_timeout')
-    wait_timeout = time.time() + wait_timeout
-    while wait_timeout > time.time():
-        refreshed = refresh_device_list(module, created_devices)
-        if all_have_public_ip(refreshed, address_family):
-            return refreshed
-        time.sleep(5)
+def wait_for_processed_devices(module, processed_devices, wait_token, deadline=None):
+    """
+    Wait, within a single wait_timeout, or until deadline if given, for the
+    processed devices to be as described by wait_token.  Return the
+    processed devices, refreshed if they were waited for.
+    """
+    device_ids, is_ready = device_readiness([wait_token])
+    device_ids = set(device_ids)
+    watched_devices = [d for d in processed_devices if d.id in device_ids]
+    if not watched_devices:
+        return processed_devices
 
-    raise Exception("Waiting for IPv%d address timed out. Hostnames: %s"
-                    % (address_family, [d.hostname for d in created_devices]))
+    try:
+        refresh = DeviceEventsRefresh(lambda devices: refresh_device_list(module, devices), module.metal_conn)
+        timeout = module.params.get('wait_timeout') if deadline is None else deadline - time.time()
+        refreshed = wait_for_devices(refresh, watched_devices, is_ready, timeout)
+    except WaitTimeout as e:
+        conditions = []
+        if wait_token['active_device_ids']:
+            conditions.append('state "active"')
+        if any(d.id in wait_token['public_ip_device_ids'] for d in e.devices):
+            conditions.append('IPv%d address' % wait_token['public_ipv'])
+        raise Exception("Waiting for %s timed out for devices: %s"
+                        % (' and '.join(conditions), [d.hostname for d in e.devices]))
+
+    refreshed = dict((d.id, d) for d in refreshed)
+    return [refreshed.get(d.id, d) for d in processed_devices]
 
 
 def get_specified_device_identifiers(module):
@@ -386,8 +786,14 @@ def get_specified_device_identifiers(module):
 
 
 def act_on_devices(module, target_state):
+    # not imported with the module, see import_metal_sdk
+    import packet
+
     specified_identifiers = get_specified_device_identifiers(module)
-    existing_devices = module.get_devices()
+    if specified_identifiers['hostnames']:
+        existing_devices = find_devices_by_hostname(module, specified_identifiers['hostnames'])
+    else:
+        existing_devices = find_devices_by_id(module, specified_identifiers['ids'])
     changed = False
     create_hostnames = []
     if target_state in ['present', 'active', 'rebooted']:
@@ -395,6 +801,8 @@ def act_on_devices(module, target_state):
         existing_devices_names = [ed.hostname for ed in existing_devices]
         create_hostnames = [hn for hn in specified_identifiers['hostnames']
                             if hn not in existing_devices_names]
+        if create_hostnames:
+            validate_creation_params(module)
 
     process_devices = [d for d in existing_devices
                        if (d.id in specified_identifiers['ids'])
@@ -418,36 +826,47 @@ def act_on_devices(module, target_state):
         }
 
         # First do non-creation actions, it might be faster
+        operations = []
         for d in process_devices:
             if d.state == target_state:
                 continue
             if d.state in state_map[target_state]:
                 api_operation = state_map[target_state].get(d.state)
                 if api_operation is not None:
-                    api_operation(d)
-                    # TODO: update device status after operation
-                    changed = True
+                    operations.append((d, api_operation))
             else:
                 _msg = (
                     "I don't know how to process existing device %s from state %s "
                     "to state %s" %
                     (d.hostname, d.state, target_state))
                 raise Exception(_msg)
+        if operations:
+            # TODO: update device status after operation
+            run_device_operations(module, operations, process_devices)
+            changed = True
 
-    # At last create missing devices
+    # At last create missing devices, within the same wait_timeout as the wait for them
+    deadline = time.time() + module.params.get('wait_timeout')
     created_devices = []
     if create_hostnames:
-        created_devices = [create_single_device(module, n)
-                           for n in create_hostnames]
-        if module.params.get('wait_for_public_IPv'):
-            created_devices = wait_for_public_IPv(
-                module, created_devices)
+        created_devices, failed_hostnames, pending_batch_ids = create_devices(module, create_hostnames, deadline)
+        if failed_hostnames:
+            fail_partial_creation(module, changed, created_devices, failed_hostnames, pending_batch_ids)
         changed = True
 
     processed_devices = created_devices + process_devices
-    if target_state == 'active':
-        processed_devices = wait_for_devices_active(
-            module, processed_devices)
+    wait_token = device_wait_token(
+        active_device_ids=[d.id for d in processed_devices] if target_state == 'active' else [],
+        public_ip_device_ids=[d.id for d in created_devices],
+        public_ipv=module.params.get('wait_for_public_IPv'))
+    if not module.params.get('wait'):
+        return {
+            'changed': changed,
+            'devices': [serialize_device(d) for d in processed_devices],
+            'wait_token': wait_token,
+        }
+
+    processed_devices = wait_for_processed_devices(module, processed_devices, wait_token, deadline)
 
     return {
         'changed': changed,
@@ -462,6 +881,7 @@ def main():
             count_offset=dict(type='int', default=1),
             device_ids=dict(type='list', elements='str'),
             facility=dict(),
+            facilities=dict(type='list', elements='str'),
             features=dict(type='dict'),
             hostnames=dict(type='list', elements='str', aliases=['name']),
             tags=dict(type='list', elements='str'),
@@ -472,12 +892,19 @@ def main():
             user_data=dict(default=None),
             wait_for_public_IPv=dict(type='int', choices=[4, 6]),
             wait_timeout=dict(type='int', default=900),
+            wait=dict(type='bool', default=True),
+            batch=dict(type='bool', default=True),
+            preflight_checks=dict(type='bool', default=True),
             ipxe_script_url=dict(default=''),
             always_pxe=dict(type='bool', default=False),
+            max_workers=dict(type='int', default=10),
+            on_partial_failure=dict(choices=['keep', 'rollback'], default='keep'),
         ),
+        catalog_cache_arg=True,
         required_one_of=[('device_ids', 'hostnames',)],
         mutually_exclusive=[
             ('hostnames', 'device_ids'),
+            ('facility', 'facilities'),
             ('count', 'device_ids'),
             ('count_offset', 'device_ids'),
         ]
@@ -490,6 +917,9 @@ def main():
 
     try:
         module.exit_json(**act_on_devices(module, state))
+    except DeviceActionError as e:
+        module.fail_json(msg='failed to set device state %s, error: %s' %
+                         (state, to_native(e)), **e.result)
     except Exception as e:
         module.fail_json(msg='failed to set device state %s, error: %s' %
                          (state, to_native(e)), exception=traceback.format_exc())
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = '''
+module: device_wait
+short_description: Wait for Equinix Metal devices to be ready
+description:
+    - Wait for devices created or changed by M(equinix.metal.device) with I(wait=false) to be active, or to have a public IP address.
+    - The devices of all the given wait tokens are polled together, so that the devices of several M(equinix.metal.device) tasks
+      are provisioned at the same time, and waited for at once.
+    - Devices are only fetched again when the events of their project mention them, or every minute.
+    - API is documented at U(https://metal.equinix.com/developers/api/devices/).
+version_added: 1.5.0
+author:
+    - Equinix Metal (@equinix)
+extends_documentation_fragment:
+     - equinix.metal.metal
+options:
+    wait_tokens:
+        description:
+            - The I(wait_token) results of M(equinix.metal.device) tasks.
+        required: true
+        type: list
+        elements: dict
+    wait_timeout:
+        description:
+            - How long (seconds) to wait for all the devices to be ready.
+        default: 900
+        type: int
+    max_workers:
+        description:
+            - How many devices to fetch at the same time when polling them.
+        default: 10
+        type: int
+'''
+
+EXAMPLES = '''
+# All the examples assume that you have your Equinix Metal API token in env var METAL_API_TOKEN.
+# You can also pass it to the api_token parameter of the module instead.
+
+- name: Start the provisioning of devices in two facilities, then wait for all of them
+  hosts: localhost
+  tasks:
+  - equinix.metal.device:
+      project_id: 89b497ee-5afc-420a-8fb5-56984898f4df
+      hostnames: "{{ item }}-%02d"
+      count: 10
+      operating_system: ubuntu_16_04
+      plan: baremetal_0
+      facility: "{{ item }}"
+      state: active
+      wait_for_public_IPv: 4
+      wait: false
+    loop: [sjc1, ewr1]
+    register: provisioning
+
+  - equinix.metal.device_wait:
+      wait_tokens: "{{ provisioning.results | map(attribute='wait_token') | list }}"
+    register: provisioned
+'''
+
+RETURN = '''
+devices:
+    description: Information about each device waited for, once ready
+    type: list
+    sample: '[{"hostname": "my-server.com", "id": "2a5122b9-c323-4d5c-b53c-9ad3f54273e7",
+               "public_ipv4": "147.229.15.12", "private-ipv4": "10.0.15.12",
+               "tags": [], "locked": false, "state": "active",
+               "public_ipv6": ""2604:1380:2:5200::3"}]'
+    returned: success
+'''  # NOQA
+
+
+import time
+import traceback
+
+from ansible.module_utils._text import to_native
+
+from ansible_collections.equinix.metal.plugins.module_utils.metal import (
+    AnsibleMetalModule,
+    DeviceEventsRefresh,
+    WaitTimeout,
+    device_readiness,
+    map_concurrently,
+    serialize_device,
+    wait_for_devices,
+)
+
+
+def fetch_devices(module, device_ids):
+    results = map_concurrently(lambda device_id: module.new_manager().get_device(device_id), device_ids,
+                               module.params.get('max_workers'))
+    for device_id, (_, error) in zip(device_ids, results):
+        if error is not None:
+            raise Exception("Could not fetch device %s: %s" % (device_id, to_native(error)))
+    return [device for device, _ in results]
+
+
+def wait_for_tokens(module):
+    deadline = time.time() + module.params.get('wait_timeout')
+    device_ids, is_ready = device_readiness(module.params.get('wait_tokens'))
+
+    devices = fetch_devices(module, device_ids)
+    try:
+        refresh = DeviceEventsRefresh(lambda pending: fetch_devices(module, [d.id for d in pending]), module.metal_conn)
+        devices = wait_for_devices(refresh, devices, is_ready, deadline - time.time())
+    except WaitTimeout as e:
+        raise Exception("Waiting timed out for devices: %s" % [d.hostname for d in e.devices])
+
+    return {
+        'changed': False,
+        'devices': [serialize_device(d) for d in devices]
+    }
+
+
+def main():
+    module = AnsibleMetalModule(
+        argument_spec=dict(
+            wait_tokens=dict(type='list', elements='dict', required=True, no_log=False),
+            wait_timeout=dict(type='int', default=900),
+            max_workers=dict(type='int', default=10),
+        ),
+        project_id_arg=False,
+        supports_check_mode=True,
+    )
+
+    try:
+        module.exit_json(**wait_for_tokens(module))
+    except Exception as e:
+        module.fail_json(msg='failed to wait for devices, error: %s' %
+                         (to_native(e)), exception=traceback.format_exc())
+
+
+if __name__ == '__main__':
+    main()
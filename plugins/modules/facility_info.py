@@ -20,6 +20,7 @@ author:
     - Jason DeTiberus (@detiber) <jdetiberus@equinix.com>
 extends_documentation_fragment:
      - equinix.metal.metal
+     - equinix.metal.metal_catalog_cache
 options:
     codes:
         description:
@@ -79,7 +80,7 @@ from ansible_collections.equinix.metal.plugins.module_utils.metal import Ansible
 
 
 def get_facility_info(module):
-    facilities = module.metal_conn.list_facilities()
+    facilities = module.list_facilities()
 
     if module.params.get('ids'):
         facilities = [f for f in facilities if f.id in module.params.get('ids')]
@@ -94,6 +95,7 @@ def get_facility_info(module):
 def main():
     module = AnsibleMetalModule(
         project_id_arg=False,
+        catalog_cache_arg=True,
         argument_spec=dict(
             ids=dict(type='list', elements='str'),
             codes=dict(type='list', elements='str'),
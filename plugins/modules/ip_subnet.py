@@ -167,7 +167,7 @@ def act_on_assignment(target_state, module):
     if hostname is None and device_id is None:
         if target_state == 'absent':
             # The special case to release the IP from any assignment
-            for d in module.get_devices():
+            for d in module.iter_devices():
                 for ip in d.ip_addresses():
                     if ip['address'] == address and ip['cidr'] == prefixlen:
                         module.metal_conn.delete_ip(ip['id'])
@@ -181,8 +181,13 @@ def act_on_assignment(target_state, module):
     if device_id is not None:
         device = module.metal_conn.get_device(device_id)
     else:
-        all_devices = module.get_devices()
-        matching_devices = [d for d in all_devices if d.hostname == hostname]
+        matching_devices = []
+        # the search filter matches the hostname partially, among other attributes
+        for d in module.iter_devices(search=hostname):
+            if d.hostname == hostname:
+                matching_devices.append(d)
+                if len(matching_devices) > 1:
+                    break
         if len(matching_devices) > 1:
             raise Exception("There are more than one devices matching given hostname {0}".format(hostname))
         if len(matching_devices) == 0:
@@ -20,6 +20,7 @@ author:
     - Jason DeTiberus (@detiber) <jdetiberus@equinix.com>
 extends_documentation_fragment:
      - equinix.metal.metal
+     - equinix.metal.metal_catalog_cache
 options:
     slugs:
         description:
@@ -92,7 +93,7 @@ from ansible_collections.equinix.metal.plugins.module_utils.metal import Ansible
 
 
 def get_operating_system_info(module):
-    operating_systems = module.metal_conn.list_operating_systems(params={'include': 'available_in'})
+    operating_systems = module.list_operating_systems(params={'include': 'available_in'})
 
     if module.params.get('slugs'):
         operating_systems = [o for o in operating_systems if o.slug in module.params.get('slugs')]
@@ -107,6 +108,7 @@ def get_operating_system_info(module):
 def main():
     module = AnsibleMetalModule(
         project_id_arg=False,
+        catalog_cache_arg=True,
         argument_spec=dict(
             slugs=dict(type='list', elements='str'),
             distros=dict(type='list', elements='str'),
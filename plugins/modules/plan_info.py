@@ -20,6 +20,7 @@ author:
     - Jason DeTiberus (@detiber) <jdetiberus@equinix.com>
 extends_documentation_fragment:
      - equinix.metal.metal
+     - equinix.metal.metal_catalog_cache
 options:
     names:
         description:
@@ -108,7 +109,7 @@ from ansible_collections.equinix.metal.plugins.module_utils.metal import Ansible
 
 
 def get_plan_info(module):
-    plans = module.metal_conn.list_plans(params={'include': 'available_in'})
+    plans = module.list_plans(params={'include': 'available_in'})
 
     if module.params.get('ids'):
         plans = [p for p in plans if p.id in module.params.get('ids')]
@@ -123,6 +124,7 @@ def get_plan_info(module):
 def main():
     module = AnsibleMetalModule(
         project_id_arg=False,
+        catalog_cache_arg=True,
         argument_spec=dict(
             ids=dict(type='list', elements='str'),
             names=dict(type='list', elements='str'),
@@ -107,16 +107,13 @@ id:
 
 from ansible.module_utils._text import to_native
 
-HAS_METAL_SDK = True
-try:
-    import packet
-except ImportError:
-    HAS_METAL_SDK = False
-
-from ansible_collections.equinix.metal.plugins.module_utils.metal import AnsibleMetalModule
+from ansible_collections.equinix.metal.plugins.module_utils.metal import HAS_METAL_SDK, AnsibleMetalModule
 
 
 def act_on_project(target_state, module):
+    # not imported with the module, see import_metal_sdk
+    import packet
+
     result_dict = {'changed': False}
     given_id = module.params.get('id')
     given_name = module.params.get('name')
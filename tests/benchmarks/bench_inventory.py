@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Benchmark the equinix.metal.device inventory plugin against a local fake
+Equinix Metal API (see fake_metal_api.py).
+
+For every fleet size the inventory is parsed twice in a fresh python process,
+using the jsonfile cache plugin: once with an empty cache (query the API,
+populate the inventory, store the cache) and once more from the cache (load
+the cache, populate the inventory).  The wall time, the API calls, the peak
+RSS of the process and the time spent in each phase are reported.
+
+Run it from a checkout living in an ``ansible_collections/equinix/metal``
+directory, or point ANSIBLE_COLLECTIONS_PATH to the directory containing
+``ansible_collections`` (ansible-core >= 2.15 and packet-python must be
+installed)::
+
+    python tests/benchmarks/bench_inventory.py --devices 100 1000 5000 20000
+    python tests/benchmarks/bench_inventory.py --projects 20 --latency 0.05 --option max_workers=8
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+COLLECTION_DIR = os.path.dirname(os.path.dirname(BENCHMARKS_DIR))
+COLLECTIONS_ROOT = os.environ.get('ANSIBLE_COLLECTIONS_PATH', '').split(os.pathsep)[0] or \
+    os.path.dirname(os.path.dirname(os.path.dirname(COLLECTION_DIR)))
+
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_metal_api import FakeMetalAPI  # noqa: E402
+
+INVENTORY_CONFIG = {
+    'plugin': 'equinix.metal.device',
+    'api_token': 'benchmark',
+    'cache': True,
+    'cache_plugin': 'jsonfile',
+    'strict': False,
+    'keyed_groups': [
+        {'prefix': 'tag', 'key': 'tags'},
+        {'prefix': 'equinix_metal_plan', 'key': 'plan'},
+        {'prefix': 'equinix_metal_facility', 'key': 'facility'},
+        {'prefix': 'equinix_metal_state', 'key': 'state'},
+    ],
+    'compose': {
+        'ansible_host': "(ip_addresses | selectattr('address_family', 'equalto', 4) | selectattr('public', 'equalto', false) | first).address",
+    },
+}
+
+PHASES = ('projects', 'query', 'populate', 'cache load', 'cache store')
+
+
+class PhaseTimer(object):
+    """Accumulate the time spent in wrapped callables, per phase"""
+
+    def __init__(self):
+        self.timings = defaultdict(float)
+
+    def wrap(self, owner, name, phase):
+        original = getattr(owner, name)
+        timings = self.timings
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timings[phase] += time.time() - start
+
+        setattr(owner, name, timed)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def child(args):
+    """Parse the inventory twice in this process and print the measurements as JSON"""
+    sys.path.insert(0, COLLECTIONS_ROOT)
+
+    from ansible.inventory.data import InventoryData
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.plugins.cache import CachePluginAdjudicator
+    from ansible.plugins.loader import init_plugin_loader, inventory_loader
+
+    init_plugin_loader([COLLECTIONS_ROOT])
+
+    from ansible_collections.equinix.metal.plugins.inventory import device
+
+    timer = PhaseTimer()
+    timer.wrap(device.InventoryModule, '_get_project_ids', 'projects')
+    timer.wrap(device.InventoryModule, '_query', 'query')
+    timer.wrap(device.InventoryModule, '_populate', 'populate')
+    timer.wrap(device, 'decode_results', 'cache load')
+    timer.wrap(CachePluginAdjudicator, '__getitem__', 'cache load')
+    timer.wrap(device, 'encode_results', 'cache store')
+    timer.wrap(CachePluginAdjudicator, 'update_cache_if_changed', 'cache store')
+
+    connect = device.InventoryModule._connect
+
+    def local_connect(self):
+        manager = connect(self)
+        manager.end_point = args.url
+        return manager
+    device.InventoryModule._connect = local_connect
+
+    results = {}
+    for run in ('cold', 'warm'):
+        timer.timings.clear()
+        plugin = inventory_loader.get('equinix.metal.device')
+        inventory = InventoryData()
+        start = time.time()
+        plugin.parse(inventory, DataLoader(), args.config, cache=True)
+        plugin.update_cache_if_changed()
+        results[run] = {
+            'wall': time.time() - start,
+            'hosts': len(inventory.hosts),
+            'phases': dict(timer.timings),
+        }
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    print(json.dumps(results))
+
+
+def measure(args, devices, workdir):
+    """Run the child process against a fake API with the given number of devices per project"""
+    config = dict(INVENTORY_CONFIG)
+    config['cache_connection'] = os.path.join(workdir, 'cache-%d' % devices)
+    config['snapshot_dir'] = os.path.join(workdir, 'snapshots-%d' % devices)
+    for option in args.option:
+        name, value = option.split('=', 1)
+        config[name] = json.loads(value) if value[:1] in '[{0123456789' or value in ('true', 'false') else value
+
+    # the plugin only accepts configuration files with this suffix; JSON is valid YAML
+    config_path = os.path.join(workdir, 'benchmark-%d.equinix_metal.yml' % devices)
+    with open(config_path, 'w') as f:
+        json.dump(config, f)
+
+    with FakeMetalAPI(projects=args.projects, devices=devices, default_per_page=args.default_per_page,
+                      latency=args.latency) as api:
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child', '--url', api.url, '--config', config_path],
+            env=dict(os.environ, ANSIBLE_COLLECTIONS_PATH=COLLECTIONS_ROOT),
+        )
+        calls = dict(api.calls)
+
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['api_calls'] = calls
+    return result
+
+
+def report(fleet, result):
+    print('{0} devices, {1:.0f} MB peak RSS'.format(fleet, result['peak_rss_mb']))
+    print('  API calls: {0}'.format(', '.join('{0}={1}'.format(k, v) for k, v in sorted(result['api_calls'].items())) or 'none'))
+    for run in ('cold', 'warm'):
+        data = result[run]
+        phases = ', '.join('{0}={1:.3f}s'.format(p, data['phases'][p]) for p in PHASES if p in data['phases'])
+        print('  {0}: {1:.3f}s for {2} hosts ({3})'.format(run, data['wall'], data['hosts'], phases))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, nargs='+', default=[100, 1000, 5000, 20000],
+                        help='fleet sizes to measure, in devices over all projects')
+    parser.add_argument('--projects', type=int, default=1, help='number of projects the fleet is spread over')
+    parser.add_argument('--default-per-page', type=int, default=10,
+                        help='page size of the fake API when the client does not ask for one')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--option', action='append', default=[],
+                        help='extra inventory option as name=value, e.g. max_workers=8 (may be repeated)')
+    parser.add_argument('--json', action='store_true', help='print the raw measurements as JSON')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    workdir = tempfile.mkdtemp(prefix='equinix_metal_bench_')
+    try:
+        results = {}
+        for fleet in args.devices:
+            results[fleet] = measure(args, max(1, fleet // args.projects), workdir)
+            if not args.json:
+                report(fleet, results[fleet])
+        if args.json:
+            print(json.dumps(results, indent=2, sort_keys=True))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
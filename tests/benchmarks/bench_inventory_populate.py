@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Measure how long the device inventory plugin takes to add hosts to the
+inventory, compared to setting every host variable and evaluating every
+constructed option separately for each host.
+
+Run it from a checkout living in an ``ansible_collections/equinix/metal``
+directory, with that tree on the python path, e.g.::
+
+    PYTHONPATH=../../.. python tests/benchmarks/bench_inventory_populate.py --hosts 5000
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import time
+
+from ansible.inventory.data import InventoryData
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+
+try:
+    from ansible.template import trust_as_template
+except ImportError:
+    # ansible-core < 2.19 does not track template trust
+    def trust_as_template(value):
+        return value
+
+from ansible_collections.equinix.metal.plugins.inventory.device import InventoryModule
+
+
+OPTIONS = {
+    'strict': True,
+    'compose': {
+        'ansible_host': trust_as_template(
+            "(ip_addresses | selectattr('address_family', 'equalto', 4) | selectattr('public', 'equalto', false) | first).address"
+        ),
+    },
+    'groups': {
+        'locked': trust_as_template('locked'),
+    },
+    'keyed_groups': [
+        {'prefix': 'tag', 'key': trust_as_template('tags')},
+        {'prefix': 'equinix_metal_plan', 'key': trust_as_template('plan')},
+        {'prefix': 'equinix_metal_facility', 'key': trust_as_template('facility')},
+        {'prefix': 'equinix_metal_state', 'key': trust_as_template('state')},
+    ],
+}
+
+
+def fake_host(i):
+    return {
+        'id': '00000000-0000-4000-8000-%012d' % i,
+        'hostname': 'host-%05d' % i,
+        'state': ('active', 'provisioning', 'inactive')[i % 3],
+        'locked': i % 2 == 0,
+        'tags': ['cluster-%d' % (i % 10), 'role-%d' % (i % 4)],
+        'plan': ('c3.small.x86', 'm3.large.x86')[i % 2],
+        'facility': ('am6', 'da11', 'sv15', 'ny5')[i % 4],
+        'operating_system': 'ubuntu_20_04',
+        'project': 'project',
+        'created_at': '2021-03-01T00:00:00Z',
+        'updated_at': '2021-03-01T00:00:00Z',
+        'ip_addresses': [
+            {'address': '147.75.%d.%d' % (i // 250 % 250, i % 250), 'address_family': 4, 'public': True},
+            {'address': '10.0.%d.%d' % (i // 250 % 250, i % 250), 'address_family': 4, 'public': False},
+        ],
+    }
+
+
+def per_host_add_hosts(plugin, hosts, group):
+    """Reference: resolve options, set variables and evaluate constructed options separately per host"""
+    for host in hosts:
+        hostname = host['hostname']
+
+        plugin.inventory.add_host(hostname, group=group)
+        for hostvar, hostval in host.items():
+            plugin.inventory.set_variable(hostname, hostvar, hostval)
+
+        strict = plugin.get_option('strict')
+        plugin._set_composite_vars(plugin.get_option('compose'), host, hostname, strict=strict)
+        plugin._add_host_to_composed_groups(plugin.get_option('groups'), host, hostname, strict=strict)
+        plugin._add_host_to_keyed_groups(plugin.get_option('keyed_groups'), host, hostname, strict=strict)
+
+
+def new_plugin():
+    plugin = InventoryModule()
+    plugin.inventory = InventoryData()
+    plugin.templar = Templar(loader=DataLoader())
+    plugin.get_option = OPTIONS.get
+    plugin.inventory.add_group('equinix_metal')
+    return plugin
+
+
+def run(add_hosts, hosts):
+    plugin = new_plugin()
+    start = time.time()
+    add_hosts(plugin, hosts, 'equinix_metal')
+    elapsed = time.time() - start
+    return elapsed, plugin.inventory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=5000, help='number of hosts to add')
+    parser.add_argument('--rounds', type=int, default=3, help='number of measurements, the best one is reported')
+    args = parser.parse_args()
+
+    hosts = [fake_host(i) for i in range(args.hosts)]
+
+    results = {}
+    for name, add_hosts in (('per host', per_host_add_hosts),
+                            ('plugin', lambda plugin, hosts, group: plugin._add_hosts(hosts, group))):
+        timings = []
+        for dummy in range(args.rounds):
+            elapsed, inventory = run(add_hosts, hosts)
+            timings.append(elapsed)
+        results[name] = (min(timings), inventory)
+        print('{0:>10}: {1:8.3f}s for {2} hosts'.format(name, min(timings), args.hosts))
+
+    reference, plugin = results['per host'][1], results['plugin'][1]
+    assert sorted(reference.groups) == sorted(plugin.groups) and len(plugin.groups) > 3
+    assert all(reference.hosts[h].vars == plugin.hosts[h].vars for h in reference.hosts)
+    print('{0:>10}: {1:8.2f}x'.format('speedup', results['per host'][0] / results['plugin'][0]))
+
+
+if __name__ == '__main__':
+    main()
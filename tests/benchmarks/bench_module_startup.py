@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+Benchmark the startup of the modules of this collection.
+
+Every run starts a fresh python process which, like a module invocation,
+imports the module_utils, creates an AnsibleMetalModule from arguments given
+on stdin and exits, optionally after creating the API client (without
+calling the API).  Runs are made with the SDK imported when the API client is
+created (lazy, the default of the modules) and right after the module_utils
+(eager, the behaviour of the modules up to 1.4).  The median time spent in
+each phase and the median wall time of the processes are reported.
+
+Run it from a checkout living in an ``ansible_collections/equinix/metal``
+directory, or point ANSIBLE_COLLECTIONS_PATH to the directory containing
+``ansible_collections`` (ansible-core and packet-python must be installed)::
+
+    python tests/benchmarks/bench_module_startup.py --runs 50
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+COLLECTION_DIR = os.path.dirname(os.path.dirname(BENCHMARKS_DIR))
+COLLECTIONS_ROOT = os.environ.get('ANSIBLE_COLLECTIONS_PATH', '').split(os.pathsep)[0] or \
+    os.path.dirname(os.path.dirname(os.path.dirname(COLLECTION_DIR)))
+
+# tells the child processes what to measure, AnsibleModule parsing their command line
+CHILD_ENV = 'EQUINIX_METAL_BENCH_MODULE_STARTUP'
+MODULE_ARGS = {'api_token': 'benchmark', 'project_id': '2a5122b9-c323-4d5c-b53c-9ad3f54273e7'}
+PHASES = ('import', 'init', 'client')
+SCENARIOS = (
+    # name, import the SDK with the module_utils, create the API client
+    ('lazy, exit before calling the API', False, False),
+    ('eager, exit before calling the API', True, False),
+    ('lazy, first API call', False, True),
+    ('eager, first API call', True, True),
+)
+
+
+def child(eager, client):
+    """Start a module in this process and print the time spent in each phase as JSON"""
+    timings = {}
+
+    start = time.time()
+    from ansible_collections.equinix.metal.plugins.module_utils import metal
+    if eager:
+        metal.import_metal_sdk()
+    timings['import'] = time.time() - start
+
+    start = time.time()
+    module = metal.AnsibleMetalModule(argument_spec=dict())
+    timings['init'] = time.time() - start
+
+    if client:
+        start = time.time()
+        module.metal_conn
+        timings['client'] = time.time() - start
+
+    timings['sdk_imported'] = 'packet' in sys.modules
+    try:
+        module.exit_json(changed=False)
+    except SystemExit:
+        pass
+    print(json.dumps(timings))
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def measure(runs, eager, client):
+    """Start runs child processes and return the median of their phases and wall times"""
+    command = [sys.executable, os.path.abspath(__file__)]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([COLLECTIONS_ROOT] + sys.path))
+    env[CHILD_ENV] = json.dumps({'eager': eager, 'client': client})
+    module_args = json.dumps({'ANSIBLE_MODULE_ARGS': MODULE_ARGS}).encode('utf-8')
+
+    samples = []
+    for _ in range(runs):
+        start = time.time()
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        output, _ = process.communicate(module_args)
+        wall = time.time() - start
+        if process.returncode:
+            raise Exception('module startup failed: %s' % output)
+        sample = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        sample['wall'] = wall
+        samples.append(sample)
+
+    result = dict((phase, median([s[phase] for s in samples])) for phase in PHASES + ('wall',) if phase in samples[0])
+    result['sdk_imported'] = samples[0]['sdk_imported']
+    return result
+
+
+def report(name, result):
+    phases = ', '.join('{0}={1:.1f}ms'.format(p, result[p] * 1000) for p in PHASES if p in result)
+    print('{0}: {1:.1f}ms ({2}, SDK {3})'.format(
+        name, result['wall'] * 1000, phases, 'imported' if result['sdk_imported'] else 'not imported'))
+
+
+def main():
+    if CHILD_ENV in os.environ:
+        return child(**json.loads(os.environ[CHILD_ENV]))
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20, help='processes started per scenario')
+    parser.add_argument('--json', action='store_true', help='print the raw measurements as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for name, eager, client in SCENARIOS:
+        results[name] = measure(args.runs, eager, client)
+        if not args.json:
+            report(name, results[name])
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
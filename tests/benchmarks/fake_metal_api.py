@@ -0,0 +1,277 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+"""
+A local stand-in for the parts of the Equinix Metal API read by the device
+inventory plugin: the project listing, the paginated project device listing
+(including the ``exclude`` query parameter) and single device lookups.
+
+Devices are generated on the fly from their index, so fleets of any size cost
+no memory up front and every run sees the same data.
+"""
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+FACILITIES = ['am6', 'da11', 'dc13', 'fr2', 'ny5', 'sg1', 'sv15', 'ty11']
+PLANS = ['c3.small.x86', 'c3.medium.x86', 'm3.large.x86', 's3.xlarge.x86']
+OPERATING_SYSTEMS = ['ubuntu_20_04', 'centos_8', 'debian_10', 'flatcar_stable']
+STATES = ['active', 'active', 'active', 'provisioning', 'inactive']
+MAX_PER_PAGE = 1000
+
+PROJECT_DEVICES_RE = re.compile(r'^/projects/([^/]+)/devices$')
+DEVICE_RE = re.compile(r'^/devices/(\d{8}-0000-4000-9000-\d{12})$')
+
+
+def project_id(index):
+    return '00000000-0000-4000-8000-%012d' % index
+
+
+def device_id(project_index, index):
+    return '%08d-0000-4000-9000-%012d' % (project_index, index)
+
+
+def ip_address(address, family, public, cidr):
+    return {
+        'id': 'ip-' + address,
+        'address': address,
+        'address_family': family,
+        'public': public,
+        'cidr': cidr,
+        'enabled': True,
+        'gateway': address,
+        'global_ip': False,
+        'manageable': True,
+        'management': True,
+        'netmask': '255.255.255.254' if family == 4 else 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:fff0',
+        'network': address,
+        'tags': [],
+        'href': '/ips/ip-' + address,
+        'created_at': '2021-03-01T00:00:00Z',
+    }
+
+
+def make_device(project_index, index):
+    facility = FACILITIES[index % len(FACILITIES)]
+    plan = PLANS[index % len(PLANS)]
+    os_slug = OPERATING_SYSTEMS[index % len(OPERATING_SYSTEMS)]
+    octets = (index // 250 % 250, index % 250)
+    return {
+        'id': device_id(project_index, index),
+        'short_id': device_id(project_index, index)[:8],
+        'hostname': 'p%d-host-%05d' % (project_index, index),
+        'description': None,
+        'state': STATES[index % len(STATES)],
+        'tags': ['cluster-%d' % (index % 10), 'role-%d' % (index % 4)],
+        'billing_cycle': 'hourly',
+        'user': 'ansible',
+        'iqn': 'iqn.2021-03.net.packet:device.%08d' % index,
+        'locked': index % 7 == 0,
+        'bonding_mode': 4,
+        'created_at': '2021-03-01T00:00:00Z',
+        'updated_at': '2021-03-01T00:00:00Z',
+        'ipxe_script_url': None,
+        'always_pxe': False,
+        'customdata': {'role': 'role-%d' % (index % 4)},
+        'userdata': '',
+        'switch_uuid': 'switch-%d' % (index % 40),
+        'href': '/devices/' + device_id(project_index, index),
+        'operating_system': {
+            'id': 'os-' + os_slug,
+            'slug': os_slug,
+            'name': os_slug.replace('_', ' '),
+            'distro': os_slug.split('_')[0],
+            'version': '1',
+            'provisionable_on': PLANS,
+            'pricing': {},
+        },
+        'facility': {
+            'id': 'facility-' + facility,
+            'code': facility,
+            'name': facility.upper(),
+            'features': ['baremetal', 'layer_2', 'global_ipv4', 'backend_transfer'],
+            'address': {'address': '1 Main St', 'city': facility, 'country': 'XX'},
+        },
+        'plan': {
+            'id': 'plan-' + plan,
+            'slug': plan,
+            'name': plan,
+            'line': 'baremetal',
+            'pricing': {'hour': 1.0},
+            'available_in': [{'href': '/facilities/facility-' + f} for f in FACILITIES],
+            'specs': {
+                'cpus': [{'count': 1, 'type': 'AMD EPYC 7402P'}],
+                'memory': {'total': '64GB'},
+                'drives': [{'count': 2, 'size': '480GB', 'type': 'SSD'}],
+                'nics': [{'count': 2, 'type': '10Gbps'}],
+            },
+        },
+        'project': {'href': '/projects/' + project_id(project_index)},
+        'project_lite': {'href': '/projects/' + project_id(project_index)},
+        'ssh_keys': [{'href': '/ssh-keys/key-%d' % k} for k in range(3)],
+        'volumes': [],
+        'network_ports': [
+            {
+                'id': 'port-%d-%d' % (index, port),
+                'name': 'eth%d' % port,
+                'type': 'NetworkPort',
+                'data': {'bonded': True, 'mac': '0c:c4:7a:%02x:%02x:%02x' % (port, octets[0], octets[1])},
+                'virtual_networks': [],
+                'href': '/ports/port-%d-%d' % (index, port),
+            }
+            for port in range(3)
+        ],
+        'ip_addresses': [
+            ip_address('147.75.%d.%d' % octets, 4, True, 31),
+            ip_address('2604:1380:%x::%x' % octets, 6, True, 127),
+            ip_address('10.%d.%d.1' % octets, 4, False, 31),
+        ],
+    }
+
+
+def apply_exclude(data, exclude):
+    """Reduce excluded attributes to their href, like the API does"""
+    for path in exclude:
+        target = data
+        keys = path.split('.')
+        for key in keys[:-1]:
+            target = target.get(key)
+            if not isinstance(target, dict):
+                break
+        else:
+            value = target.get(keys[-1])
+            if isinstance(value, dict):
+                target[keys[-1]] = {'href': value['href']} if 'href' in value else {}
+            elif isinstance(value, list):
+                target[keys[-1]] = [{'href': v['href']} if isinstance(v, dict) and 'href' in v else {} for v in value]
+            elif keys[-1] in target:
+                del target[keys[-1]]
+    return data
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMetalAPI(object):
+    """
+    Serve a fake fleet on 127.0.0.1 from a background thread.
+
+    :param projects: number of projects
+    :param devices: number of devices per project
+    :param default_per_page: page size used when the client does not ask for one
+    :param latency: seconds added to every response, to emulate network round-trips
+    """
+
+    def __init__(self, projects=1, devices=100, default_per_page=10, latency=0.0):
+        self.projects = projects
+        self.devices = devices
+        self.default_per_page = default_per_page
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive, like the real API, without waiting on
+            # delayed ACKs between the headers and the body of a response
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                status, body = api.handle(self.path)
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake_metal_api')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, raw_path):
+        url = urlparse(raw_path)
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        path = '/' + url.path.strip('/')
+        exclude = [e for e in query.get('exclude', '').split(',') if e]
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        match = PROJECT_DEVICES_RE.match(path)
+        if path == '/projects':
+            self._count('projects')
+            projects = [{'id': project_id(i), 'name': 'project-%d' % i, 'href': '/projects/' + project_id(i)}
+                        for i in range(self.projects)]
+            return 200, {'projects': projects, 'meta': {'total': self.projects, 'next': None}}
+        elif match:
+            self._count('project devices')
+            try:
+                project_index = [project_id(i) for i in range(self.projects)].index(match.group(1))
+            except ValueError:
+                return 404, {'errors': ['Not found']}
+            page = int(query.get('page', 1))
+            per_page = min(int(query.get('per_page', self.default_per_page)), MAX_PER_PAGE)
+            start = (page - 1) * per_page
+            stop = min(start + per_page, self.devices)
+            devices = [apply_exclude(make_device(project_index, i), exclude) for i in range(start, stop)]
+            last_page = max(1, (self.devices + per_page - 1) // per_page)
+            next_page = {'href': '%s?page=%d' % (path, page + 1)} if page < last_page else None
+            return 200, {'devices': devices, 'meta': {'total': self.devices, 'current_page': page,
+                                                      'last_page': last_page, 'next': next_page}}
+
+        match = DEVICE_RE.match(path)
+        if match:
+            self._count('device')
+            parts = match.group(1).split('-')
+            project_index, index = int(parts[0]), int(parts[-1])
+            if project_index >= self.projects or index >= self.devices:
+                return 404, {'errors': ['Not found']}
+            return 200, apply_exclude(make_device(project_index, index), exclude)
+
+        self._count('unknown')
+        return 404, {'errors': ['Not found']}
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] += 1
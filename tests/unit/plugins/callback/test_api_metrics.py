@@ -0,0 +1,62 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import json
+import os
+import uuid
+
+from ansible_collections.equinix.metal.plugins.callback.api_metrics import CallbackModule
+from ansible_collections.equinix.metal.plugins.module_utils.metal import API_METRICS_FILE_OFFSETS, ApiMetrics
+
+
+def task_result(mocker, task, host, endpoints, loop=False):
+    result = mocker.MagicMock()
+    result._task.get_name.return_value = task
+    result._host.get_name.return_value = host
+    metrics = {'metal_metrics': {'endpoints': endpoints}}
+    result._result = {'results': [metrics]} if loop else metrics
+    return result
+
+
+def endpoint(calls, elapsed, histogram, throttled=0):
+    return {'calls': calls, 'errors': throttled, 'retries': throttled, 'throttled': throttled, 'bytes_sent': 0,
+            'bytes_received': 100 * calls, 'elapsed': elapsed, 'max_elapsed': 3.0, 'latency_histogram': histogram}
+
+
+def test_summary_per_play(mocker, tmp_path):
+    metrics_file = tmp_path / 'metrics.jsonl'
+    # a previous run with the same pid, then the inventory of this run and a concurrent run
+    metrics_file.write_text(json.dumps({'pid': os.getpid(), 'run': 'previous', 'endpoint': 'GET /projects', 'status': 200}) + u'\n')
+    inventory = ApiMetrics(str(metrics_file), 'equinix.metal.device')
+    mocker.patch.dict(API_METRICS_FILE_OFFSETS, clear=True)
+    inventory.record('GET', 'projects/%s/devices' % uuid.uuid4(), 200, 0.3)
+    with metrics_file.open('a') as f:
+        f.write(json.dumps({'run': 'other', 'endpoint': 'GET /devices/{id}', 'status': 200, 'elapsed': 0.3}) + u'\n')
+    options = {'metrics_file': str(metrics_file), 'slowest_tasks': 1, 'summary_file': None}
+    callback = CallbackModule(display=mocker.MagicMock(verbosity=0))
+    mocker.patch.object(callback, 'get_option', side_effect=lambda name: options[name])
+
+    callback.v2_playbook_on_start(mocker.MagicMock())
+    callback.v2_playbook_on_play_start(mocker.MagicMock(**{'get_name.return_value': 'provision'}))
+    # 9 buckets of up to 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10 seconds and more
+    callback.v2_runner_on_ok(task_result(mocker, 'create', 'localhost', {
+        'POST /projects/{id}/devices': endpoint(10, 8.0, [0, 0, 0, 0, 9, 1, 0, 0, 0]),
+        'GET /devices/{id}': endpoint(20, 2.0, [0, 10, 10, 0, 0, 0, 0, 0, 0], throttled=2),
+    }))
+    callback.v2_runner_on_failed(task_result(mocker, 'wait', 'localhost', {
+        'GET /devices/{id}': endpoint(20, 3.0, [0, 0, 19, 0, 0, 0, 0, 0, 1]),
+    }, loop=True))
+    callback.v2_playbook_on_play_start(mocker.MagicMock(**{'get_name.return_value': 'configure'}))
+
+    summary = callback.summarize()
+
+    assert [(p['play'], p['calls'], p['throttled']) for p in summary] == [('inventory', 1, 0), ('provision', 50, 2)]
+    devices = summary[1]['endpoints']['GET /devices/{id}']
+    assert (devices['calls'], devices['errors'], devices['p50'], devices['p95']) == (40, 2, 0.25, 0.25)
+    creates = summary[1]['endpoints']['POST /projects/{id}/devices']
+    assert (creates['p50'], creates['p95']) == (1.0, 2.5)
+    assert list(summary[1]['endpoints']) == ['GET /devices/{id}', 'POST /projects/{id}/devices']
+    assert summary[1]['slowest_tasks'] == [{'task': 'create', 'host': 'localhost', 'calls': 30, 'elapsed': 10.0,
+                                            'throttled': 2}]
@@ -0,0 +1,366 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import copy
+import fcntl
+import json
+import os
+import time
+
+import packet
+import pytest
+import yaml
+from packet.baseapi import ResponseError
+
+from ansible.errors import AnsibleError
+from ansible.inventory.data import InventoryData
+
+from ansible_collections.equinix.metal.plugins.inventory.device import (
+    DOCUMENTATION,
+    REVALIDATE_SCRIPT,
+    InventoryModule,
+    decode_results,
+    encode_results,
+)
+
+
+PROJECT_DEVICES = {
+    'project-a': [{'hostname': 'a1'}, {'hostname': 'a2'}],
+    'project-b': [{'hostname': 'b1'}],
+    'project-c': [{'hostname': 'c1'}, {'hostname': 'c2'}],
+}
+
+
+@pytest.fixture
+def inventory(mocker):
+    inventory = InventoryModule()
+    options = {'max_workers': 1, 'device_exclude': ['network_ports', 'plan.specs'], 'snapshot_dir': None}
+    mocker.patch.object(inventory, 'get_option', side_effect=lambda name: options[name])
+    inventory.test_options = options
+    return inventory
+
+
+def fake_get_devices_by_project(failing=()):
+    def _get_devices_by_project(project_id):
+        if project_id in failing:
+            raise AnsibleError("Failed to query devices from Equinix Metal API")
+        return list(PROJECT_DEVICES[project_id])
+    return _get_devices_by_project
+
+
+@pytest.mark.parametrize('max_workers', [1, 3, 8])
+def test_query_keeps_project_order(inventory, mocker, max_workers):
+    inventory.test_options['max_workers'] = max_workers
+    mocker.patch.object(inventory, '_get_devices_by_project', side_effect=fake_get_devices_by_project())
+
+    results = inventory._query(['project-c', 'project-a', 'project-b'])
+
+    assert [d['hostname'] for d in results['equinix_metal']] == ['c1', 'c2', 'a1', 'a2', 'b1']
+    assert inventory._failed_projects == {}
+
+
+def test_query_serial_aborts_on_error(inventory, mocker):
+    mocker.patch.object(inventory, '_get_devices_by_project', side_effect=fake_get_devices_by_project(failing=['project-b']))
+
+    with pytest.raises(AnsibleError):
+        inventory._query(['project-a', 'project-b', 'project-c'])
+
+
+def test_query_concurrent_skips_failed_projects(inventory, mocker):
+    inventory.test_options['max_workers'] = 4
+    mocker.patch.object(inventory, '_get_devices_by_project', side_effect=fake_get_devices_by_project(failing=['project-b']))
+    warning = mocker.patch.object(inventory.display, 'warning')
+
+    results = inventory._query(['project-a', 'project-b', 'project-c'])
+
+    assert [d['hostname'] for d in results['equinix_metal']] == ['a1', 'a2', 'c1', 'c2']
+    assert list(inventory._failed_projects) == ['project-b']
+    assert warning.call_count == 1
+
+
+def test_query_concurrent_fails_when_all_projects_fail(inventory, mocker):
+    inventory.test_options['max_workers'] = 4
+    mocker.patch.object(inventory, '_get_devices_by_project', side_effect=fake_get_devices_by_project(failing=['project-a', 'project-b']))
+    mocker.patch.object(inventory.display, 'warning')
+
+    with pytest.raises(AnsibleError):
+        inventory._query(['project-a', 'project-b'])
+
+
+def test_get_devices_by_project_excludes_fields(inventory, mocker):
+    manager = mocker.MagicMock()
+    manager.meta = {'next': None}
+    manager.call_api.return_value = {'devices': [{
+        'id': 'device-id',
+        'hostname': 'a1',
+        'state': 'active',
+        'tags': ['web'],
+        'locked': False,
+        'plan': {'slug': 'c3.small.x86'},
+        'facility': {'code': 'am6'},
+        'operating_system': {'slug': 'ubuntu_20_04'},
+        'project': {'href': '/projects/project-a'},
+        'ip_addresses': [],
+    }]}
+    mocker.patch.object(inventory, '_connect', return_value=manager)
+
+    devices = inventory._get_devices_by_project('project-a')
+
+    manager.call_api.assert_called_once_with('projects/project-a/devices',
+                                             params={'page': 1, 'per_page': 1000, 'exclude': 'network_ports,plan.specs'})
+    assert devices[0]['hostname'] == 'a1'
+    assert devices[0]['plan'] == 'c3.small.x86'
+    assert devices[0]['facility'] == 'am6'
+    assert devices[0]['operating_system'] == 'ubuntu_20_04'
+
+
+def full_device():
+    return {
+        'id': 'device-id',
+        'hostname': 'a1',
+        'state': 'active',
+        'tags': ['web'],
+        'locked': False,
+        'userdata': '',
+        'customdata': {'role': 'web'},
+        'plan': {'slug': 'c3.small.x86', 'specs': {'cpus': []}, 'pricing': {'hour': 1.0}, 'available_in': []},
+        'facility': {'code': 'am6', 'address': {'city': 'Amsterdam'}, 'features': ['baremetal']},
+        'operating_system': {'slug': 'ubuntu_20_04', 'provisionable_on': [], 'pricing': {}},
+        'project': {'href': '/projects/project-a'},
+        'project_lite': {'href': '/projects/project-a'},
+        'ssh_keys': [{'href': '/ssh-keys/key'}],
+        'volumes': [],
+        'network_ports': [{'id': 'port', 'name': 'eth0'}],
+        'provisioning_events': [],
+        'ip_addresses': [],
+    }
+
+
+def test_device_exclude_keeps_host_vars(inventory, mocker):
+    default_exclude = yaml.safe_load(DOCUMENTATION)['options']['device_exclude']['default']
+    excluded = full_device()
+    for path in default_exclude:
+        parent, _, key = path.rpartition('.')
+        (excluded[parent] if parent else excluded).pop(key, None)
+
+    inventory.test_options['device_exclude'] = []
+    full_vars = inventory._get_host_info_dict_from_device(packet.Device(full_device(), None))
+    inventory.test_options['device_exclude'] = default_exclude
+    excluded_vars = inventory._get_host_info_dict_from_device(packet.Device(copy.deepcopy(excluded), None))
+
+    assert excluded_vars == full_vars
+
+
+def raw_device(device_id, updated_at):
+    return {
+        'id': device_id,
+        'hostname': 'host-' + device_id,
+        'updated_at': updated_at,
+        'operating_system': {'slug': 'ubuntu_20_04'},
+    }
+
+
+def test_refresh_devices_by_project_fetches_only_changes(inventory, mocker):
+    listed = [raw_device('1', 't1'), raw_device('2', 't2'), raw_device('3', 't1'), raw_device('4', 't1'), raw_device('5', 't1')]
+    manager = mocker.MagicMock()
+    manager.meta = {'next': None}
+
+    def call_api(path, params=None):
+        if path == 'projects/project-a/devices':
+            return {'devices': listed}
+        return dict(raw_device(path.split('/')[1], 't2'), hostname='fresh')
+    manager.call_api.side_effect = call_api
+    mocker.patch.object(inventory, '_connect', return_value=manager)
+
+    previous = [inventory._get_host_info_dict_from_device(packet.Device(raw_device(device_id, 't1'), manager))
+                for device_id in ('0', '1', '2', '3', '4', '5')]
+    inventory._previous_devices = {'project-a': previous}
+
+    devices = inventory._get_devices_by_project('project-a')
+
+    # '0' was deleted and '2' was updated
+    assert [d['id'] for d in devices] == ['1', '2', '3', '4', '5']
+    assert [d['hostname'] for d in devices] == ['host-1', 'fresh', 'host-3', 'host-4', 'host-5']
+    assert [c[0][0] for c in manager.call_api.call_args_list] == ['projects/project-a/devices', 'devices/2']
+
+
+def test_refresh_devices_by_project_fetches_changes_concurrently(inventory, mocker):
+    inventory.test_options['max_workers'] = 4
+    listed = [raw_device(str(i), 't2' if i % 2 else 't1') for i in range(6)]
+    manager = mocker.MagicMock()
+    manager.meta = {'next': None}
+    not_found = ResponseError(mocker.MagicMock(status_code=404), {'errors': ['Not found']})
+
+    def call_api(path, params=None):
+        if path == 'projects/project-a/devices':
+            return {'devices': listed}
+        if path == 'devices/3':
+            raise not_found
+        return dict(raw_device(path.split('/')[1], 't2'), hostname='fresh')
+    manager.call_api.side_effect = call_api
+    mocker.patch.object(inventory, '_connect', return_value=manager)
+    mocker.patch('ansible_collections.equinix.metal.plugins.inventory.device.DEVICE_PER_PAGE', 2)
+    previous = [inventory._get_host_info_dict_from_device(packet.Device(raw_device(str(i), 't1'), manager)) for i in range(6)]
+
+    # 3 changed devices, 3 pages of devices: fetch the changed ones
+    devices = inventory._refresh_devices_by_project('project-a', previous)
+    assert [(d['id'], d['hostname']) for d in devices] == [
+        ('0', 'host-0'), ('1', 'fresh'), ('2', 'host-2'), ('4', 'host-4'), ('5', 'fresh')]
+    assert sorted(c[0][0] for c in manager.call_api.call_args_list[1:]) == ['devices/1', 'devices/3', 'devices/5']
+
+    # 4 changed devices: list the project again
+    manager.call_api.reset_mock()
+    inventory._refresh_devices_by_project('project-a', previous[1:])
+    assert [c[0][0] for c in manager.call_api.call_args_list] == ['projects/project-a/devices'] * 2
+
+
+def test_snapshot_round_trip(inventory, tmp_path):
+    inventory.test_options['snapshot_dir'] = str(tmp_path)
+    inventory._project_devices = {'project-a': [{'id': '1', 'hostname': 'a1'}]}
+
+    inventory._save_snapshot('cache_key')
+
+    assert inventory._load_snapshot('cache_key')['projects'] == {'project-a': [{'id': '1', 'hostname': 'a1'}]}
+    assert inventory._load_snapshot('other_key') == {}
+
+    # taken with other attributes than the listings now have
+    inventory.test_options['device_exclude'] = ['network_ports']
+    assert inventory._load_snapshot('cache_key') == {}
+
+
+def test_query_shares_max_workers_between_projects_and_their_devices(inventory, mocker):
+    inventory.test_options['max_workers'] = 8
+    device_workers = {}
+
+    def get_devices_by_project(project_id):
+        device_workers[project_id] = inventory._device_workers
+        return []
+    mocker.patch.object(inventory, '_get_devices_by_project', side_effect=get_devices_by_project)
+
+    inventory._query(['project-a', 'project-b', 'project-c'])
+    assert device_workers == {'project-a': 2, 'project-b': 2, 'project-c': 2}
+    inventory._query(['project-a'])
+    assert device_workers['project-a'] is None
+
+
+@pytest.mark.parametrize('age, projects, expected', [
+    (100, [], ['a1', 'b1']),
+    (100, ['project-b'], ['b1']),
+    (100, ['project-c'], None),
+    (5000, [], None),
+])
+def test_get_stale_results(inventory, mocker, age, projects, expected):
+    inventory.test_options.update({'cache_timeout': 3600, 'max_stale': 600, 'projects': projects})
+    mocker.patch.object(inventory, '_load_snapshot', return_value={
+        'timestamp': time.time() - age,
+        'projects': {'project-a': [{'hostname': 'a1'}], 'project-b': [{'hostname': 'b1'}]},
+    })
+
+    results = inventory._get_stale_results('cache_key')
+
+    if expected is None:
+        assert results is None
+    else:
+        assert [d['hostname'] for d in results['equinix_metal']] == expected
+
+
+def test_revalidate_in_background_starts_detached_process(inventory, mocker, tmp_path):
+    inventory.test_options['snapshot_dir'] = str(tmp_path)
+    popen = mocker.patch('subprocess.Popen')
+    refresh = mocker.patch.object(inventory, '_refresh')
+
+    process = inventory._revalidate_in_background('inventory.equinix_metal.yml', 'cache_key')
+
+    assert process is popen.return_value
+    # nothing is refreshed in this process
+    refresh.assert_not_called()
+    args, kwargs = popen.call_args
+    command = args[0]
+    assert command[1:3] == ['-c', REVALIDATE_SCRIPT]
+    assert os.path.isdir(os.path.join(command[3], 'ansible_collections', 'equinix', 'metal'))
+    assert command[4] == os.path.abspath('inventory.equinix_metal.yml')
+    assert kwargs['stdout'].name == str(tmp_path / 'cache_key.log')
+    assert kwargs['start_new_session']
+    assert len(kwargs['pass_fds']) == 1
+
+
+def test_revalidate_in_background_once_at_a_time(inventory, mocker, tmp_path):
+    inventory.test_options['snapshot_dir'] = str(tmp_path)
+    popen = mocker.patch('subprocess.Popen')
+
+    # like the process of a previous run, still refreshing
+    with open(str(tmp_path / 'cache_key.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        assert inventory._revalidate_in_background('inventory.equinix_metal.yml', 'cache_key') is None
+        popen.assert_not_called()
+
+    assert inventory._revalidate_in_background('inventory.equinix_metal.yml', 'cache_key') is popen.return_value
+
+
+def test_add_hosts_sets_variables_through_the_inventory(inventory, mocker):
+    inventory.test_options.update({'strict': False, 'compose': {}, 'groups': {}, 'keyed_groups': [], 'use_extra_vars': False})
+    inventory.inventory = InventoryData()
+    inventory.inventory.add_group('equinix_metal')
+    set_variable = mocker.spy(inventory.inventory, 'set_variable')
+    host = {'hostname': 'a1', 'plan': 'c3.small.x86', 'tags': ['web']}
+
+    inventory._add_hosts([host], 'equinix_metal')
+
+    calls = [c[0] for c in set_variable.call_args_list]
+    assert all(('a1', k, v) in calls for k, v in host.items())
+    assert dict(inventory.inventory.get_host('a1').vars, **host) == inventory.inventory.get_host('a1').vars
+
+
+@pytest.mark.parametrize('template, templated', [
+    ('plan', False),
+    ('true', True),
+    ('plan | upper', True),
+    ('unknown', True),
+])
+def test_compose_looks_up_bare_names(inventory, mocker, template, templated):
+    compose = mocker.patch('ansible.plugins.inventory.Constructable._compose', return_value='templated')
+    inventory._lookup_bare_names = True
+
+    result = inventory._compose(template, {'plan': 'c3.small.x86', 'true': 'no'})
+
+    assert compose.called == templated
+    assert result == ('templated' if templated else 'c3.small.x86')
+
+
+def host_dict(i):
+    return {
+        'id': 'device-%d' % i,
+        'hostname': 'host-%d' % i,
+        'state': 'active',
+        'locked': i % 2 == 0,
+        'plan': 'c3.small.x86',
+        'facility': ['am6', 'da11'][i % 2],
+        'operating_system': 'ubuntu_20_04',
+        'project': '',
+        'tags': ['web'],
+        'ip_addresses': [{
+            'address': '10.0.0.%d' % i, 'address_family': 4, 'public': False, 'cidr': 31, 'enabled': True,
+            'gateway': '10.0.0.0', 'global_ip': False, 'manageable': True, 'management': True,
+            'netmask': '255.255.255.254', 'network': '10.0.0.0', 'tags': [],
+        }],
+    }
+
+
+def test_cache_encoding_round_trip():
+    devices = [host_dict(i) for i in range(50)]
+    devices[3]['state'] = None
+    devices[4]['ip_addresses'].append({'address': '10.0.1.1'})
+    del devices[5]['tags']
+    results = {'equinix_metal': devices}
+
+    encoded = encode_results(results)
+
+    assert json.loads(json.dumps(decode_results(encoded))) == results
+    assert len(json.dumps(encoded)) < len(json.dumps(results)) / 2
+
+
+def test_cache_decoding_keeps_plain_inventory():
+    results = {'equinix_metal': [host_dict(1)]}
+    assert decode_results(results) == results
@@ -5,11 +5,37 @@
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
+import json
 import pytest
 import os
+import subprocess
+import sys
 import unittest
 
-from ansible_collections.equinix.metal.plugins.module_utils.metal import AnsibleMetalModule, is_valid_hostname
+import packet
+import requests
+from packet.baseapi import Error as MetalError, ResponseError
+
+from ansible_collections.equinix.metal.plugins import module_utils
+from ansible_collections.equinix.metal.plugins.module_utils.metal import (
+    AnsibleMetalModule,
+    ApiMetrics,
+    CatalogCache,
+    CatalogIndex,
+    DeviceEventsRefresh,
+    MIN_REQUEST_RATE,
+    RequestScheduler,
+    SharedRequestBudget,
+    WaitTimeout,
+    device_readiness,
+    device_wait_token,
+    import_metal_sdk,
+    is_valid_hostname,
+    map_concurrently,
+    poll_delays,
+    wait_for_devices,
+)
+from ansible_collections.equinix.metal.plugins.module_utils.metal_api import MetalManager, is_retryable
 
 
 @pytest.mark.parametrize('stdin', [{}], indirect=['stdin'])
@@ -62,6 +88,40 @@ def test_get_api_token_param_stdin_pref(stdin):
     assert module.params.get('api_token') == 'deadbeef'
 
 
+def test_sdk_is_imported_by_the_first_api_call():
+    # in a new interpreter, the SDK being imported in this one already
+    script = '''
+import json, sys
+from ansible_collections.equinix.metal.plugins.module_utils.metal import AnsibleMetalModule
+module = AnsibleMetalModule(argument_spec=dict(), project_id_arg=False)
+imported = ['packet' in sys.modules]
+module.metal_conn
+imported.append('packet' in sys.modules)
+print(json.dumps(imported))
+'''
+    process = subprocess.Popen([sys.executable, '-c', script], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+    output, _ = process.communicate(json.dumps({'ANSIBLE_MODULE_ARGS': {'api_token': 'deadbeef'}}).encode('utf-8'))
+    assert json.loads(output.decode('utf-8').strip().splitlines()[-1]) == [False, True]
+
+
+@pytest.mark.parametrize('stdin', [{'api_token': 'deadbeef'}], indirect=['stdin'])
+def test_missing_sdk_fails_the_module(stdin, capsys, mocker, monkeypatch):
+    module = AnsibleMetalModule(argument_spec=dict(), project_id_arg=False)
+    # as if packet-python was missing, metal_api failing to import it
+    mocker.patch.dict('sys.modules', {'ansible_collections.equinix.metal.plugins.module_utils.metal_api': None})
+    monkeypatch.delattr(module_utils, 'metal_api')
+
+    with pytest.raises(SystemExit):
+        module.metal_conn
+
+    out, _ = capsys.readouterr()  # pylint: disable=blacklisted-name
+    result = json.loads(out)
+    assert result['failed'] and 'packet-python' in result['msg']
+    with pytest.raises(ImportError):
+        import_metal_sdk()
+
+
 class TestIsValidHostname(unittest.TestCase):
 
     def test_valid_hostname(self):
@@ -72,3 +132,362 @@ class TestIsValidHostname(unittest.TestCase):
 
     def test_underscores(self):
         self.assertFalse(is_valid_hostname("bad_hostname"))
+
+
+def test_metal_manager_uses_shared_session(mocker):
+    session = mocker.MagicMock()
+    session.get.return_value.content = b'{}'
+    session.get.return_value.ok = True
+    session.get.return_value.headers = {'content-type': 'application/json'}
+    session.get.return_value.json.return_value = {'devices': [], 'meta': {'next': None}}
+
+    first = MetalManager(auth_token='deadbeef', session=session)
+    second = MetalManager(auth_token='deadbeef', session=session)
+    assert first.list_all_devices('project') == []
+    assert second.list_devices('project', params={'page': 2}) == []
+
+    assert session.get.call_count == 2
+    assert session.get.call_args[0][0] == 'https://api.packet.net/projects/project/devices?page=2'
+    assert first.meta == {'next': None}
+
+
+@pytest.mark.parametrize('stdin', [{'api_token': 'deadbeef', 'project_id': '2a5122b9-c323-4d5c-b53c-9ad3f54273e7'}],
+                         indirect=['stdin'])
+def test_iter_devices_fetches_pages_lazily(stdin, mocker):
+    module = AnsibleMetalModule(argument_spec=dict())
+    pages = [
+        ({'devices': [{'id': 'a', 'operating_system': {}}, {'id': 'b', 'operating_system': {}}]}, {'next': {}}),
+        ({'devices': [{'id': 'c', 'operating_system': {}}]}, {'next': None}),
+    ]
+
+    def call_api(path, params=None):
+        data, module.metal_conn.meta = pages[params['page'] - 1]
+        return data
+    call_api = mocker.patch.object(module.metal_conn, 'call_api', side_effect=call_api)
+
+    devices = module.iter_devices(per_page=2, search='host')
+    assert next(devices).id == 'a'
+    call_api.assert_called_once_with('projects/2a5122b9-c323-4d5c-b53c-9ad3f54273e7/devices',
+                                     params={'per_page': 2, 'search': 'host', 'page': 1})
+
+    assert [d.id for d in module.get_devices(per_page=2)] == ['a', 'b', 'c']
+    assert call_api.call_count == 3
+
+
+@pytest.mark.parametrize('stdin', [{'api_token': 'deadbeef', 'project_id': '2a5122b9-c323-4d5c-b53c-9ad3f54273e7'}],
+                         indirect=['stdin'])
+def test_get_device_only_returns_devices_of_the_project(stdin, mocker):
+    module = AnsibleMetalModule(argument_spec=dict())
+    not_found = mocker.MagicMock(status_code=404)
+    devices = {
+        'devices/mine': {'id': 'mine', 'operating_system': {},
+                         'project': {'href': '/metal/v1/projects/2a5122b9-c323-4d5c-b53c-9ad3f54273e7'}},
+        'devices/theirs': {'id': 'theirs', 'operating_system': {}, 'project': {'href': '/metal/v1/projects/other'}},
+    }
+
+    def call_api(path, params=None):
+        if path not in devices:
+            raise ResponseError(not_found, {'errors': ['Not found']})
+        return devices[path]
+    mocker.patch.object(module.metal_conn, 'call_api', side_effect=call_api)
+
+    assert module.get_device('mine').id == 'mine'
+    assert module.get_device('theirs') is None
+    assert module.get_device('missing') is None
+
+
+@pytest.mark.parametrize('type, status_code, retryable', [
+    ('POST', 429, True),
+    ('POST', 503, True),
+    # the API may have created the device before the gateway gave up
+    ('POST', 502, False),
+    ('POST', 504, False),
+    ('POST', 422, False),
+    ('GET', 504, True),
+    ('DELETE', 502, True),
+    ('GET', 404, False),
+])
+def test_is_retryable_status_codes(type, status_code, retryable):
+    assert is_retryable(type, status_code=status_code) == retryable
+
+
+def test_is_retryable_errors():
+    timeout = MetalError('Communications error', requests.exceptions.ConnectTimeout())
+    reset = MetalError('Communications error', requests.exceptions.ConnectionError())
+
+    assert is_retryable('POST', error=timeout)
+    assert not is_retryable('POST', error=reset)
+    assert is_retryable('GET', error=reset)
+
+
+@pytest.mark.parametrize('stdin', [{'api_token': 'deadbeef', 'api_retries': 2}], indirect=['stdin'])
+def test_module_retries_apply_to_every_manager(stdin, mocker):
+    mocker.patch('time.sleep')
+    module = AnsibleMetalModule(argument_spec={}, project_id_arg=False)
+    module.metal_conn.session = session = mocker.MagicMock()
+    session.post.return_value = mocker.MagicMock(status_code=503, ok=False, content=b'', headers={})
+
+    for manager in (module.metal_conn, module.new_manager()):
+        session.post.reset_mock()
+        with pytest.raises(ResponseError):
+            manager.call_api('projects/p/devices', type='POST')
+        assert session.post.call_count == 3
+
+
+def test_map_concurrently_keeps_order_and_errors():
+    def func(item):
+        if item == 3:
+            raise ValueError(item)
+        return item * 2
+
+    results = map_concurrently(func, range(6), max_workers=4)
+    assert [r for r, e in results] == [0, 2, 4, None, 8, 10]
+    assert [type(e) for r, e in results if e is not None] == [ValueError]
+
+
+def test_poll_delays_grow_with_jitter_up_to_maximum():
+    delays = poll_delays(initial=2.0, maximum=10.0, factor=2)
+    bounds = [2.0, 4.0, 8.0, 10.0, 10.0]
+    for upper in bounds:
+        assert upper / 2 <= next(delays) <= upper
+
+
+def make_device(device_id, state='provisioning'):
+    return packet.Device({'id': device_id, 'hostname': 'host-' + device_id, 'state': state,
+                          'operating_system': {}, 'ip_addresses': []}, None)
+
+
+def test_wait_for_devices_only_refreshes_pending_devices(mocker):
+    mocker.patch('time.sleep')
+    states = {'a': ['active'], 'c': ['provisioning', 'active']}
+    refresh = mocker.MagicMock(side_effect=lambda devices: [make_device(d.id, states[d.id].pop(0)) for d in devices])
+
+    watched = [make_device('a'), make_device('b', 'active'), make_device('c')]
+    devices = wait_for_devices(refresh, watched, lambda d: d.state == 'active', 900)
+
+    assert [(d.id, d.state) for d in devices] == [('a', 'active'), ('b', 'active'), ('c', 'active')]
+    assert [[d.id for d in c[0][0]] for c in refresh.call_args_list] == [['a', 'c'], ['c']]
+
+
+def test_wait_for_devices_times_out_with_pending_devices(mocker):
+    mocker.patch('time.sleep')
+    mocker.patch('time.time', side_effect=[0, 1, 1000])
+    refresh = mocker.MagicMock(side_effect=lambda devices: devices)
+
+    with pytest.raises(WaitTimeout) as e:
+        wait_for_devices(refresh, [make_device('a', 'active'), make_device('b')], lambda d: d.state == 'active', 900)
+    assert [d.id for d in e.value.devices] == ['b']
+
+
+def test_device_readiness_merges_wait_tokens():
+    device_ids, is_ready = device_readiness([
+        device_wait_token(active_device_ids=['a', 'b'], public_ip_device_ids=['a'], public_ipv=4),
+        device_wait_token(public_ip_device_ids=['c'], public_ipv=6),
+    ])
+    assert device_ids == ['a', 'b', 'c']
+
+    public_ipv4 = [{'public': True, 'address_family': 4, 'address': '147.75.0.1'}]
+    a = make_device('a', 'active')
+    assert not is_ready(a)
+    a.ip_addresses = public_ipv4
+    assert is_ready(a)
+    assert not is_ready(make_device('b'))
+    c = make_device('c')
+    c.ip_addresses = public_ipv4
+    assert not is_ready(c)
+
+
+def test_device_events_refresh_only_fetches_devices_with_new_events(mocker):
+    clock = mocker.patch('time.time', return_value=0)
+    devices = [make_device('a'), make_device('b')]
+    for d in devices:
+        d.project = {'href': '/metal/v1/projects/p'}
+
+    feed = [{'id': 'e1', 'relationships': [{'href': '/metal/v1/devices/b'}]}]
+    manager = mocker.MagicMock(meta={'next': None})
+    manager.call_api.side_effect = lambda path, params=None: {'events': list(feed)}
+    fetch = mocker.MagicMock(side_effect=lambda stale: [make_device(d.id, 'active') for d in stale])
+    refresh = DeviceEventsRefresh(fetch, manager, full_refresh_interval=60)
+
+    # the first call fetches every device, and moves the cursor to the newest event
+    assert [d.state for d in refresh(devices)] == ['active', 'active']
+    assert manager.call_api.call_args[0][0] == 'projects/p/events'
+
+    # no new event, nothing fetched
+    clock.return_value = 10
+    assert refresh(devices) is devices
+    assert fetch.call_count == 1
+
+    feed.insert(0, {'id': 'e2', 'relationships': [{'href': '/metal/v1/devices/a'}, {'href': '/metal/v1/ips/x'}]})
+    clock.return_value = 20
+    assert [d.state for d in refresh(devices)] == ['active', 'provisioning']
+    assert [d.id for d in fetch.call_args[0][0]] == ['a']
+
+    # every device again after full_refresh_interval
+    clock.return_value = 61
+    refresh(devices)
+    assert [d.id for d in fetch.call_args[0][0]] == ['a', 'b']
+
+
+def test_catalog_cache_serves_then_revalidates(mocker, tmp_path):
+    clock = mocker.patch('time.time', return_value=1000)
+    manager = mocker.MagicMock(auth_token='deadbeef')
+    manager.get_if_modified.return_value = ({'plans': [{'slug': 'c3.small.x86'}]}, '"v1"', None)
+    cache = CatalogCache(str(tmp_path / 'catalog'), ttl=600)
+
+    assert cache.get(manager, 'plans', {'include': 'available_in'}) == {'plans': [{'slug': 'c3.small.x86'}]}
+    manager.get_if_modified.assert_called_once_with('plans', {'include': 'available_in'})
+
+    # fresh, served from the disk
+    clock.return_value = 1500
+    assert cache.get(manager, 'plans', {'include': 'available_in'}) == {'plans': [{'slug': 'c3.small.x86'}]}
+    assert manager.get_if_modified.call_count == 1
+
+    # expired and not modified, still served from the disk
+    clock.return_value = 1700
+    manager.get_if_modified.return_value = (None, '"v1"', None)
+    assert cache.get(manager, 'plans', {'include': 'available_in'}) == {'plans': [{'slug': 'c3.small.x86'}]}
+    manager.get_if_modified.assert_called_with('plans', {'include': 'available_in'}, '"v1"', None)
+
+    # other tokens and queries have their own entries
+    other = mocker.MagicMock(auth_token='cafebabe')
+    other.get_if_modified.return_value = ({'plans': []}, None, None)
+    assert cache.get(other, 'plans', {'include': 'available_in'}) == {'plans': []}
+    assert len(list((tmp_path / 'catalog').iterdir())) == 2
+
+
+def test_metal_manager_get_if_modified(mocker):
+    session = mocker.MagicMock()
+    session.get.return_value.status_code = 304
+    manager = MetalManager(auth_token='deadbeef', session=session)
+
+    assert manager.get_if_modified('plans', etag='"v1"') == (None, '"v1"', None)
+    assert session.get.call_args[1]['headers']['If-None-Match'] == '"v1"'
+
+
+def test_catalog_index_problems():
+    ubuntu = packet.OperatingSystem({'slug': 'ubuntu_20_04', 'provisionable_on': ['c3.small.x86']})
+    ubuntu.id = 'os-ubuntu'
+    index = CatalogIndex(
+        [packet.Plan({'id': 'plan-c3', 'slug': 'c3.small.x86', 'name': 'c3.small.x86',
+                      'available_in': [{'code': 'sv15'}, {'code': 'da11'}]})],
+        [ubuntu, packet.OperatingSystem({'slug': 'windows_2019', 'provisionable_on': ['m3.large.x86']})],
+    )
+
+    assert index.problems('c3.small.x86', 'ubuntu_20_04', 'sv15') == []
+    assert index.problems('c3.small.x86', 'ubuntu_20_04') == []
+    assert index.problems('c3.small.x86', 'windows_2019', 'ny5') == [
+        'plan c3.small.x86 is not available in facility ny5',
+        'operating system windows_2019 is not provisionable on plan c3.small.x86',
+    ]
+    # by ID
+    assert index.problems('plan-c3', 'os-ubuntu', 'sv15') == []
+    assert index.problems('plan-c3', 'windows_2019', 'ny5') == [
+        'plan plan-c3 is not available in facility ny5',
+        'operating system windows_2019 is not provisionable on plan plan-c3',
+    ]
+    assert index.unknown('plan-c3', 'os-ubuntu') == []
+
+    # not in the public catalogs, e.g. reserved hardware
+    assert index.problems('t1.small.x86', 'beos', 'sv15') == []
+    assert index.problems('t1.small.x86', 'windows_2019', 'sv15') == []
+    assert index.unknown('t1.small.x86', 'beos') == ['plan t1.small.x86', 'operating system beos']
+
+
+def test_request_scheduler_slows_down_when_throttled(mocker):
+    clock = mocker.patch('time.time', return_value=100.0)
+    sleep = mocker.patch('time.sleep')
+    scheduler = RequestScheduler(burst=2)
+
+    for _ in range(40):
+        scheduler.acquire()
+    assert not sleep.called
+
+    # 40 requests in the last 10 seconds: 4 per second, halved
+    scheduler.throttled(5)
+    assert scheduler.rate == 2.0
+    scheduler.acquire()
+    sleep.assert_called_once_with(5.0)
+
+    # the bucket refilled meanwhile
+    clock.return_value = 105.0
+    scheduler.acquire()
+    scheduler.acquire()
+    assert sleep.call_count == 1
+    scheduler.acquire()
+    assert sleep.call_args[0][0] == 0.5
+
+    scheduler.succeeded()
+    assert scheduler.rate == 2.5
+
+
+def test_metal_manager_records_api_metrics(mocker, tmp_path):
+    mocker.patch('time.sleep')
+    session = mocker.MagicMock()
+    throttled = mocker.MagicMock(status_code=429, ok=False, content=b'{}', headers={'Retry-After': '1'})
+    ok = mocker.MagicMock(status_code=200, ok=True, content=b'{"id": "device"}', headers={'content-type': 'application/json'})
+    ok.json.return_value = {'id': 'device'}
+    ok.request.body = None
+    path = str(tmp_path / 'metrics.jsonl')
+    manager = MetalManager(auth_token='deadbeef', session=session, scheduler=RequestScheduler(),
+                           metrics=ApiMetrics(path, 'device'))
+
+    session.get.side_effect = [throttled, ok]
+    manager.call_api('devices/3ddc5a47-5c6e-4cb4-8f5b-8f2d9a1a2d0b')
+
+    metrics = manager.metrics.as_dict()
+    assert metrics['calls'] == 2
+    stats = metrics['endpoints']['GET /devices/{id}']
+    assert (stats['calls'], stats['errors'], stats['retries'], stats['throttled']) == (2, 1, 1, 1)
+    assert stats['bytes_received'] == len(b'{}') + len(b'{"id": "device"}')
+    assert sum(stats['latency_histogram']) == 2
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert [(r['module'], r['status'], r['attempt']) for r in lines] == [('device', 429, 0), ('device', 200, 1)]
+
+
+def test_shared_request_budget_is_shared_between_processes(mocker, tmp_path):
+    clock = mocker.patch('time.time', return_value=100.0)
+    sleep = mocker.patch('time.sleep')
+    path = str(tmp_path / 'budget')
+    # two forks of the same play
+    first = SharedRequestBudget(path, rate=2.0, burst=2)
+    second = SharedRequestBudget(path, rate=2.0, burst=2)
+
+    first.acquire()
+    second.acquire()
+    assert not sleep.called
+    # the bucket is empty: the requests are owed in turn
+    first.acquire()
+    second.acquire()
+    assert [c[0][0] for c in sleep.call_args_list] == [0.5, 1.0]
+
+    # a 429 received by one fork pauses the other
+    clock.return_value = 110.0
+    first.pause(3)
+    second.acquire()
+    assert sleep.call_args[0][0] == 3.0
+
+
+def test_metal_manager_retries_throttled_and_idempotent_requests(mocker):
+    mocker.patch('time.time', return_value=100.0)
+    sleep = mocker.patch('time.sleep')
+    session = mocker.MagicMock()
+    throttled = mocker.MagicMock(status_code=429, ok=False, content=b'{}', headers={'Retry-After': '3'})
+    unavailable = mocker.MagicMock(status_code=503, ok=False, content=b'{}', headers={})
+    ok = mocker.MagicMock(status_code=200, ok=True, content=b'{}', headers={'content-type': 'application/json'})
+    ok.json.return_value = {'id': 'device'}
+    manager = MetalManager(auth_token='deadbeef', session=session, scheduler=RequestScheduler())
+
+    session.get.side_effect = [throttled, unavailable, ok]
+    assert manager.call_api('devices/device') == {'id': 'device'}
+    assert session.get.call_count == 3
+    # waits for Retry-After, then backs off from the 503 on its own
+    assert [c[0][0] for c in sleep.call_args_list][:2] == [3.0, 2]
+    assert manager.scheduler.rate == MIN_REQUEST_RATE + 1 / MIN_REQUEST_RATE
+
+    # a create request is not retried after a gateway error
+    session.post.side_effect = [mocker.MagicMock(status_code=504, ok=False, content=b'{}', headers={})]
+    with pytest.raises(ResponseError):
+        manager.call_api('projects/p/devices', type='POST')
+    assert session.post.call_count == 1
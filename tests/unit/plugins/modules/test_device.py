@@ -0,0 +1,337 @@
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import time
+from collections import OrderedDict
+
+import packet
+import pytest
+from packet.baseapi import ResponseError
+
+from ansible_collections.equinix.metal.plugins.module_utils.metal import CatalogIndex, RequestScheduler
+from ansible_collections.equinix.metal.plugins.module_utils.metal_api import MetalManager
+from ansible_collections.equinix.metal.plugins.modules import device
+
+
+def make_device(device_id, state='provisioning'):
+    return packet.Device({'id': device_id, 'hostname': 'host-' + device_id, 'state': state,
+                          'operating_system': {}, 'ip_addresses': []}, None)
+
+
+@pytest.fixture
+def module(mocker):
+    module = mocker.MagicMock()
+    module.params = {'wait_timeout': 900, 'max_workers': 1, 'api_retries': 0}
+    mocker.patch('time.sleep')
+    return module
+
+
+def test_wait_for_processed_devices_waits_for_active_state_and_ip_together(module):
+    module.params['wait_for_public_IPv'] = 4
+    public_ip = {'public': True, 'address_family': 4, 'address': '147.75.0.1'}
+    polls = {
+        'new': [('provisioning', []), ('active', []), ('active', [public_ip])],
+        'old': [('provisioning', []), ('active', [])],
+    }
+
+    def get_device(device_id, manager=None):
+        d = make_device(device_id)
+        d.state, d.ip_addresses = polls[device_id].pop(0)
+        return d
+    module.get_device.side_effect = get_device
+
+    token = device.device_wait_token(active_device_ids=['new', 'old'], public_ip_device_ids=['new'], public_ipv=4)
+    processed = device.wait_for_processed_devices(module, [make_device('new'), make_device('old')], token)
+
+    assert [(d.id, d.state) for d in processed] == [('new', 'active'), ('old', 'active')]
+    assert processed[0].ip_addresses == [public_ip]
+    assert module.get_device.call_count == 5
+
+
+def test_wait_for_processed_devices_reports_the_conditions_timed_out(module, mocker):
+    mocker.patch('time.time', side_effect=[0, 1000])
+    token = device.device_wait_token(active_device_ids=['a', 'b'], public_ip_device_ids=['a'], public_ipv=6)
+
+    with pytest.raises(Exception) as e:
+        device.wait_for_processed_devices(module, [make_device('a', 'active'), make_device('b')], token)
+    assert str(e.value) == 'Waiting for state "active" and IPv6 address timed out for devices: [\'host-a\', \'host-b\']'
+    assert module.get_device.call_count == 0
+
+
+CREATION_PARAMS = {'project_id': 'p', 'plan': 'c3.small.x86', 'facility': 'sv15', 'operating_system': 'ubuntu',
+                   'locked': False, 'tags': None, 'user_data': None, 'ipxe_script_url': '', 'always_pxe': False,
+                   'batch': True, 'wait': True}
+
+
+def test_create_devices_in_batch_creates_missing_devices_one_by_one(module):
+    module.params.update(CREATION_PARAMS)
+    created = dict((hn, {'id': 'id-' + hn, 'hostname': hn, 'operating_system': {}}) for hn in ('s1', 's3'))
+    responses = {
+        'projects/p/devices/batch': {'batches': [{'id': 'b1'}]},
+        'batches/b1': [{'state': 'processing'},
+                       {'state': 'failed', 'error_messages': ['no capacity'], 'devices': [created['s3']]}],
+    }
+
+    def call_api(path, type='GET', params=None):
+        response = responses[path]
+        return response.pop(0) if isinstance(response, list) else response
+    module.metal_conn.call_api.side_effect = call_api
+    module.new_manager.return_value.create_device.side_effect = \
+        lambda hostname, **kwargs: packet.Device(created[hostname], None)
+
+    devices, failed, pending_batch_ids = device.create_devices(module, ['s1', 's2', 's3'], time.time() + 900)
+
+    assert [d.hostname for d in devices] == ['s1', 's3']
+    assert (list(failed), pending_batch_ids) == (['s2'], [])
+    batch = module.metal_conn.call_api.call_args_list[0][1]['params']['batches'][0]
+    assert (batch.pop('hostnames'), batch.pop('quantity')) == (['s1', 's2', 's3'], 3)
+    calls = module.new_manager.return_value.create_device.call_args_list
+    assert [c[1]['hostname'] for c in calls] == ['s1', 's2']
+    # the batch has the parameters of the single device requests
+    single = dict(calls[0][1])
+    del single['hostname'], single['project_id'], single['ipxe_script_url'], single['always_pxe']
+    assert batch == single
+
+
+def test_create_devices_sends_the_same_parameters_with_and_without_batch(module):
+    module.params.update(CREATION_PARAMS, features={'tpm': 'required'}, operating_system='custom_ipxe',
+                         ipxe_script_url='https://example.com/boot.ipxe', always_pxe=True)
+    module.metal_conn.call_api.side_effect = [
+        {'batches': [{'id': 'b1'}]},
+        {'state': 'completed', 'devices': [{'id': 'id-s1', 'hostname': 's1', 'operating_system': {}}]},
+    ]
+    module.new_manager.return_value.create_device.side_effect = \
+        lambda hostname, **kwargs: packet.Device({'id': 'id-' + hostname, 'hostname': hostname, 'operating_system': {}}, None)
+
+    device.create_devices(module, ['s1', 's2'], time.time() + 900)
+
+    batch = module.metal_conn.call_api.call_args_list[0][1]['params']['batches'][0]
+    single = module.new_manager.return_value.create_device.call_args[1]
+    assert (batch['features'], batch['billing_cycle']) == ({'tpm': 'required'}, 'hourly')
+    for key, value in batch.items():
+        if key not in ('hostnames', 'quantity'):
+            assert single[key] == value
+
+
+@pytest.mark.parametrize('status_code, one_by_one', [(422, True), (502, False), (504, False)])
+def test_create_devices_in_batch_only_falls_back_when_rejected(module, mocker, status_code, one_by_one):
+    module.params.update(CREATION_PARAMS)
+    error = ResponseError(mocker.MagicMock(status_code=status_code, headers={}), {'errors': ['nope']})
+    module.metal_conn.call_api.side_effect = error
+    module.new_manager.return_value.create_device.side_effect = \
+        lambda hostname, **kwargs: packet.Device({'id': 'id-' + hostname, 'hostname': hostname, 'operating_system': {}}, None)
+
+    if one_by_one:
+        devices, failed, _ = device.create_devices(module, ['s1', 's2'], time.time() + 900)
+        assert ([d.hostname for d in devices], list(failed)) == (['s1', 's2'], [])
+    else:
+        with pytest.raises(ResponseError):
+            device.create_devices(module, ['s1', 's2'], time.time() + 900)
+        module.new_manager.return_value.create_device.assert_not_called()
+
+
+def test_act_on_devices_without_wait_returns_the_devices_of_the_batch(module):
+    module.params.update(CREATION_PARAMS, wait=False, hostnames=['s%d'], count=2, count_offset=1, device_ids=None,
+                         facilities=None, preflight_checks=False, wait_for_public_IPv=None)
+    module.iter_devices.return_value = iter([])
+    responses = {
+        'projects/p/devices/batch': {'batches': [{'id': 'b1'}]},
+        'batches/b1': [{'state': 'processing'},
+                       {'state': 'completed', 'devices': [{'id': 'id-' + hn, 'hostname': hn, 'operating_system': {},
+                                                           'ip_addresses': []} for hn in ('s2', 's1')]}],
+    }
+
+    def call_api(path, type='GET', params=None):
+        response = responses[path]
+        return response.pop(0) if isinstance(response, list) else response
+    module.metal_conn.call_api.side_effect = call_api
+
+    result = device.act_on_devices(module, 'present')
+
+    assert result['changed']
+    assert [(d['hostname'], d['id']) for d in result['devices']] == [('s1', 'id-s1'), ('s2', 'id-s2')]
+    assert result['wait_token'] == device.device_wait_token()
+    module.new_manager.return_value.create_device.assert_not_called()
+
+
+def test_create_devices_in_batch_reports_batches_not_processed_in_time(module, mocker):
+    module.params.update(CREATION_PARAMS, facilities=['sv15', 'da11'])
+    module.get_capacity.return_value = {'sv15': {'c3.small.x86': {'level': 'normal', 'available_servers': 1}},
+                                        'da11': {'c3.small.x86': {'level': 'normal'}}}
+    responses = {
+        'projects/p/devices/batch': {'batches': [{'id': 'b1'}, {'id': 'b2'}]},
+        'batches/b1': {'state': 'completed', 'devices': [{'id': 'id-s1', 'hostname': 's1', 'operating_system': {}}]},
+        'batches/b2': {'state': 'processing'},
+    }
+    module.metal_conn.call_api.side_effect = lambda path, type='GET', params=None: responses[path]
+    mocker.patch('time.time', side_effect=[100, 101])
+
+    devices, failed, pending_batch_ids = device.create_devices(module, ['s1', 's2', 's3'], 100)
+
+    assert [d.hostname for d in devices] == ['s1']
+    assert failed == {'s2': 'batch b2 not processed within wait_timeout', 's3': 'batch b2 not processed within wait_timeout'}
+    assert pending_batch_ids == ['b2']
+    module.new_manager.return_value.create_device.assert_not_called()
+
+
+def test_create_devices_sends_retries_plus_one_requests(module, mocker):
+    module.params.update(CREATION_PARAMS, batch=False, api_retries=2)
+    session = mocker.MagicMock()
+    session.post.return_value = mocker.MagicMock(status_code=503, ok=False, content=b'', headers={})
+    module.new_manager.side_effect = lambda: MetalManager(auth_token='deadbeef', session=session, scheduler=RequestScheduler(),
+                                                          max_retries=module.params['api_retries'])
+
+    devices, failed, _ = device.create_devices(module, ['s1'], time.time() + 900)
+
+    assert (devices, list(failed)) == ([], ['s1'])
+    assert session.post.call_count == 3
+
+
+@pytest.mark.parametrize('on_partial_failure', ['keep', 'rollback'])
+def test_fail_partial_creation_reports_created_and_failed_devices(module, on_partial_failure):
+    module.params['on_partial_failure'] = on_partial_failure
+    created = [make_device('a'), make_device('b')]
+    failed = OrderedDict([('host-c', 'no capacity')])
+
+    with pytest.raises(device.DeviceActionError) as e:
+        device.fail_partial_creation(module, False, created, failed)
+
+    result = e.value.result
+    assert str(e.value) == 'could not create host-c (no capacity)'
+    assert (result['changed'], result['created_hostnames'], result['failed_hostnames']) == (True, ['host-a', 'host-b'], ['host-c'])
+    if on_partial_failure == 'keep':
+        assert [d['id'] for d in result['devices']] == ['a', 'b']
+        assert 'rolled_back_hostnames' not in result
+        module.new_manager.assert_not_called()
+    else:
+        assert (result['devices'], result['rolled_back_hostnames']) == ([], ['host-a', 'host-b'])
+        assert [c[0] for c in module.new_manager.return_value.call_api.call_args_list] == [('devices/a',), ('devices/b',)]
+
+
+def test_fail_partial_creation_reports_pending_batches(module):
+    module.params['on_partial_failure'] = 'rollback'
+    failed = OrderedDict([('host-b', 'batch b2 not processed within wait_timeout')])
+    with pytest.raises(device.DeviceActionError) as e:
+        device.fail_partial_creation(module, False, [make_device('a')], failed, ['b2'])
+
+    result = e.value.result
+    assert str(e.value) == ('could not create host-b (batch b2 not processed within wait_timeout), and batches b2, '
+                            'still being processed, may create devices later, which will not be rolled back')
+    assert (result['pending_batch_ids'], result['rolled_back_hostnames']) == (['b2'], ['host-a'])
+
+
+def test_fail_partial_creation_reports_devices_not_rolled_back(module, mocker):
+    module.params['on_partial_failure'] = 'rollback'
+    error = ResponseError(mocker.MagicMock(status_code=500, headers={}), {'errors': ['oops']})
+    module.new_manager.return_value.call_api.side_effect = [None, error]
+    with pytest.raises(device.DeviceActionError) as e:
+        device.fail_partial_creation(module, True, [make_device('a'), make_device('b')], OrderedDict([('host-c', 'no capacity')]))
+
+    result = e.value.result
+    assert str(e.value).startswith('could not create host-c (no capacity), and could not roll back host-b (')
+    assert result['rolled_back_hostnames'] == ['host-a']
+    assert [d['id'] for d in result['devices']] == ['b']
+
+
+def test_run_device_operations_gives_each_device_its_own_manager(module, mocker):
+    managers = [mocker.MagicMock(name='manager-a'), mocker.MagicMock(name='manager-b')]
+    module.new_manager.side_effect = list(managers)
+    devices = [make_device('a', 'active'), make_device('b', 'active')]
+    seen = {}
+
+    def power_off(d):
+        seen[d.id] = d.manager
+    power_off.__name__ = 'power_off'
+
+    device.run_device_operations(module, [(d, power_off) for d in devices], devices)
+
+    assert seen == {'a': managers[0], 'b': managers[1]}
+    assert [d.manager for d in devices] == managers
+
+
+def test_run_device_operations_reports_failed_devices(module):
+    devices = [make_device('a', 'active'), make_device('b', 'active')]
+
+    def reboot(d):
+        if d.id == 'b':
+            raise Exception('locked')
+
+    with pytest.raises(device.DeviceActionError) as e:
+        device.run_device_operations(module, [(d, reboot) for d in devices], devices)
+
+    assert str(e.value) == 'could not reboot host-b (locked)'
+    assert (e.value.result['changed'], e.value.result['failed_hostnames']) == (True, ['host-b'])
+    assert [d['id'] for d in e.value.result['devices']] == ['a', 'b']
+
+
+def test_find_devices_by_id_fetches_the_devices_concurrently(module, mocker):
+    module.params['max_workers'] = 4
+    managers = [mocker.MagicMock(name='manager-%d' % i) for i in range(3)]
+    module.new_manager.side_effect = list(managers)
+    used = []
+
+    def get_device(device_id, manager=None):
+        used.append(manager)
+        return None if device_id == 'gone' else make_device(device_id)
+    module.get_device.side_effect = get_device
+
+    found = device.find_devices_by_id(module, ['a', 'gone', 'b', 'a'])
+
+    assert [d.id for d in found] == ['a', 'b']
+    assert sorted(used, key=managers.index) == managers
+
+
+def test_find_devices_by_hostname_searches_the_hostnames_concurrently(module):
+    module.params['max_workers'] = 4
+    matches = {'web': [make_device('1'), make_device('2')], 'db': [make_device('2'), make_device('3')]}
+    for d in matches['web'] + matches['db']:
+        d.hostname = {'1': 'web', '2': 'web-old', '3': 'db'}[d.id]
+    module.iter_devices.side_effect = lambda manager=None, search=None: iter(matches[search])
+
+    found = device.find_devices_by_hostname(module, ['web', 'db', 'web'])
+
+    assert [d.id for d in found] == ['1', '3']
+    assert module.iter_devices.call_count == 2
+    assert module.new_manager.call_count == 2
+
+
+def test_find_devices_by_hostname_raises_failed_searches(module):
+    module.iter_devices.side_effect = Exception('unavailable')
+
+    with pytest.raises(Exception) as e:
+        device.find_devices_by_hostname(module, ['web'])
+    assert str(e.value) == 'unavailable'
+
+
+def test_validate_creation_params_warns_about_plans_not_in_the_catalogs(module):
+    module.params.update(CREATION_PARAMS, hostnames=['s1'], plan='reserved.plan', preflight_checks=True)
+    module.get_catalog_index.return_value = CatalogIndex(
+        [packet.Plan({'slug': 'c3.small.x86', 'available_in': [{'code': 'da11'}]})],
+        [packet.OperatingSystem({'slug': 'ubuntu', 'provisionable_on': ['c3.small.x86']})])
+
+    device.validate_creation_params(module)
+    module.warn.assert_called_once_with('Could not check plan reserved.plan, not listed by the public catalogs')
+
+    module.params['plan'] = 'c3.small.x86'
+    with pytest.raises(Exception) as e:
+        device.validate_creation_params(module)
+    assert str(e.value) == 'Cannot create devices: plan c3.small.x86 is not available in facility sv15.'
+
+
+def test_get_placement_prefers_facilities_with_stock(module):
+    module.params.update({'plan': 'c3.small.x86', 'facilities': ['sv15', 'da11', 'ny5', 'am6']})
+    module.get_capacity.return_value = {
+        'sv15': {'c3.small.x86': {'level': 'limited', 'available_servers': 5}},
+        'da11': {'c3.small.x86': {'level': 'unavailable'}},
+        'ny5': {'c3.small.x86': {'level': 'normal', 'available_servers': 2}},
+        'am6': {'m3.large.x86': {'level': 'normal'}},
+    }
+
+    placement = device.get_placement(module, ['s1', 's2', 's3', 's4'])
+    assert list(placement.items()) == [('s1', 'ny5'), ('s2', 'ny5'), ('s3', 'sv15'), ('s4', 'sv15')]
+
+    with pytest.raises(Exception) as e:
+        device.get_placement(module, ['s%d' % i for i in range(8)])
+    assert str(e.value) == 'Not enough capacity for 1 more c3.small.x86 devices in facilities sv15, da11, ny5, am6'